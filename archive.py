@@ -0,0 +1,104 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+import geotiff
+import projections
+from scheduler import summarize
+
+
+class ArchiveWriter:
+    """
+    Archive orthophotos as Cloud Optimized GeoTIFFs - directory/task id/frame id.tif - on a background thread.
+
+    Orthophotos wait in a bounded queue, so compressing and writing them never delays the live path.
+    When the queue is full, new orthophotos are dropped unless block is true.
+    A GeoTIFF is written to a temporary file and renamed, so readers never see a partial file.
+    """
+    def __init__(self, directory, queue_limit=16, block=False, compress="DEFLATE", block_size=512):
+        """
+        :param directory: The root directory of the archive
+        :param queue_limit: The maximum number of orthophotos waiting to be written
+        :param block: Wait for room in the queue instead of dropping orthophotos when it is full
+        :param compress: Compression of the GeoTIFFs - DEFLATE, ZSTD, ...
+        :param block_size: The size of the tiles of the GeoTIFFs in pixels
+        """
+        self.directory = directory
+        self.block = block
+        self.compress = compress
+        self.block_size = block_size
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.__queue = queue.Queue(maxsize=queue_limit)
+        self.__write_times = deque(maxlen=100)
+        self.__thread = threading.Thread(target=self.__run, name="archive", daemon=True)
+        self.__thread.start()
+
+    def submit(self, task_id, frame_id, orthophoto, on_written=None):
+        """
+        Queue an orthophoto to be archived. The image must not be modified afterwards
+        :param orthophoto: rectifiers.Orthophoto in EPSG 3857
+        :param on_written: Called with the orthophoto once it is written, failed or dropped, e.g. pipeline.release
+        :return: False if the orthophoto is dropped
+        """
+        try:
+            self.__queue.put((task_id, frame_id, orthophoto, on_written), block=self.block)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            if on_written is not None:
+                on_written(orthophoto)
+            return False
+
+    def stats(self):
+        return {"written": self.written, "dropped": self.dropped, "failed": self.failed,
+                "queued": self.__queue.qsize(), "write": summarize(list(self.__write_times))}
+
+    def close(self):
+        """
+        Write the orthophotos in the queue and stop the thread
+        """
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            task_id, frame_id, orthophoto, on_written = item
+            start_time = time.time()
+            try:
+                self.__write(task_id, frame_id, orthophoto)
+                self.written += 1
+                self.__write_times.append(time.time() - start_time)
+            except Exception as e:
+                self.failed += 1
+                print("archive:", e)
+            if on_written is not None:
+                on_written(orthophoto)
+
+    def __write(self, task_id, frame_id, orthophoto):
+        directory = os.path.join(self.directory, str(task_id))
+        os.makedirs(directory, exist_ok=True)
+        dst = os.path.join(directory, "%s.tif" % frame_id)
+        partial = dst + ".part"
+        geotiff.write_cog(partial, orthophoto.image, orthophoto.geotransform, projections.WEB_MERCATOR,
+                          self.compress, self.block_size)
+        os.replace(partial, dst)
+
+
+def create_archive_writer(config):
+    """
+    Create an archive writer from the archive section of config.json
+    :param config: Parsed config.json
+    :return: ArchiveWriter ... or None if ENABLED is false
+    """
+    archive = config.get("archive", {})
+    if not archive.get("ENABLED", False):
+        return None
+    return ArchiveWriter(archive.get("DIRECTORY", "archive"), queue_limit=archive.get("QUEUE_LIMIT", 16),
+                         block=archive.get("BLOCK_WHEN_FULL", False), compress=archive.get("COMPRESS", "DEFLATE"),
+                         block_size=archive.get("BLOCK_SIZE", 512))
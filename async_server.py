@@ -0,0 +1,336 @@
+import asyncio
+import gc
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from socket_module import FrameParser, pack_packet
+import pipeline
+import buffers
+from rectify_pool import RectificationPool
+from frame_ring import FrameRing, rectify_slot
+from encoders import EncoderPool, create_encoder
+from senders import create_sender
+from scheduler import create_scheduler
+from gsd_controller import create_gsd_controller
+from tiles import create_tile_pyramid, tile_wkt
+from mosaic import create_mosaic
+from coverage_index import create_coverage_index
+from archive import create_archive_writer
+
+
+def allocate_image(length):
+    # Frames wait in the work queue while the connection keeps receiving, so every frame needs its own buffer
+    return None, bytearray(length)
+
+
+class DroneProtocol(asyncio.BufferedProtocol):
+    """
+    Connection of a drone. The transport receives straight into the buffer of the parser, without a copy.
+
+    While a whole frame waits to be admitted, reading is paused, so a drone cannot run ahead of the workers.
+    """
+    def __init__(self, parser, admit, closed):
+        """
+        :param parser: socket_module.FrameParser of the connection
+        :param admit: A coroutine function admit(frame) called with every whole frame
+        :param closed: A function closed(protocol, addr) called when the connection is lost
+        """
+        self.parser = parser
+        self.__admit = admit
+        self.__closed = closed
+        self.__transport = None
+        self.__addr = None
+        self.__admitted = None
+
+    def connection_made(self, transport):
+        self.__transport = transport
+        self.__addr = transport.get_extra_info("peername")
+        print("accepted connection from", self.__addr)
+
+    def get_buffer(self, sizehint):
+        return self.parser.recv_buffer()
+
+    def buffer_updated(self, nbytes):
+        try:
+            frame = self.parser.feed(nbytes)
+        except Exception as e:
+            print(e)
+            self.__transport.close()
+            return
+        if frame is not None:
+            self.__transport.pause_reading()
+            self.__admitted = asyncio.ensure_future(self.__admit(frame))
+            self.__admitted.add_done_callback(self.__resume)
+
+    def __resume(self, admitted):
+        self.__admitted = None
+        if admitted.cancelled():
+            return
+        if admitted.exception() is not None:
+            print(admitted.exception())
+            self.__transport.close()
+        elif not self.__transport.is_closing():
+            self.__transport.resume_reading()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            print(exc)
+        self.__closed(self, self.__addr)
+
+    def close(self):
+        # A frame waiting to be admitted keeps its image, which may be in a slot of the ring
+        if self.__admitted is not None:
+            self.__admitted.cancel()
+        if self.__transport is not None:
+            self.__transport.close()
+
+
+class IngestServer:
+    """
+    Ingest server based on asyncio.
+
+    Each drone connection is received by a DroneProtocol, which admits whole frames to a FrameScheduler.
+    Under overload the scheduler keeps the latest frames of each task and drops the stale ones.
+    Workers take frames from the scheduler and run the blocking stages (decode, georeference, rectify, encode and send)
+    in executors, so a frame being processed never stalls the other connections.
+    Orthophotos are encoded once and queued to the sender of every subscriber, so a slow viewer never stalls them
+    either.
+    If rectifier.PROCESSES is not 0, frames are rectified in worker processes and sent in order per task.
+    If gsd.ADAPTIVE is true, the gsd of each task is adapted to hold the latency of rectification and encoding.
+    If tiles.ENABLED is true, the tiles of the XYZ pyramid changed by each frame are sent instead of the orthophoto.
+    If mosaic.ENABLED is true, orthophotos are also blended into the live mosaic of their task.
+    If coverage.ENABLED is true, frames whose footprint is already covered by the recent frames of their task are
+    skipped or cropped to the part not covered yet.
+    If archive.ENABLED is true, orthophotos are also written to Cloud Optimized GeoTIFFs on a background thread.
+    """
+    def __init__(self, config):
+        self.port = config["server"]["PORT"]
+        self.queue_limit = config["server"]["QUEUE_LIMIT"]
+        self.num_workers = config["server"].get("WORKERS", 2)
+
+        self.__ready = None     # asyncio.Condition notified whenever the scheduler changes
+        self.__connections = set()  # DroneProtocol of every open connection
+        self.__scheduler = create_scheduler(config, on_drop=self.__release)
+        self.__executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        self.__work_queue_limit = config["server"].get("WORK_QUEUE_LIMIT", 8)
+        self.__sender = create_sender(config)
+
+        num_processes = config.get("rectifier", {}).get("PROCESSES", 0)
+        if num_processes != 0:
+            # Keep enough frames in flight to feed every process
+            self.__pool = RectificationPool(num_processes, config)
+            self.num_workers = max(self.num_workers, num_processes or os.cpu_count())
+        else:
+            self.__pool = None
+
+        self.__encoders = EncoderPool(create_encoder(config), config.get("encoder", {}).get("WORKERS", 2))
+        self.__last_sent = {}   # task id -> future resolved when the last frame of the task is sent
+        self.__gsd = create_gsd_controller(config)
+        self.__pyramid = create_tile_pyramid(config)
+        self.__mosaic = create_mosaic(config)
+        self.__coverage = create_coverage_index(config)
+        self.__archive = create_archive_writer(config)
+        # Frames are added to the pyramid and the mosaic in order
+        self.__ordered_executor = ThreadPoolExecutor(max_workers=1)
+
+        # Images are handed to the worker processes through shared memory instead of pickling
+        ring = config.get("ring", {})
+        if self.__pool is not None and ring.get("SLOTS", 0) > 0:
+            self.__ring = FrameRing(ring["SLOTS"], int(ring["INPUT_SLOT_MB"] * 1024 * 1024),
+                                    int(ring["OUTPUT_SLOT_MB"] * 1024 * 1024))
+        else:
+            self.__ring = None
+
+    async def serve_forever(self):
+        self.__ready = asyncio.Condition()
+        workers = [asyncio.ensure_future(self.__work()) for _ in range(self.num_workers)]
+
+        server = await asyncio.get_event_loop().create_server(self.__connect, port=self.port,
+                                                              backlog=self.queue_limit, reuse_address=True)
+        print("listening on", ("", self.port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            for connection in list(self.__connections):
+                connection.close()
+                self.__abort(connection.parser)
+            await asyncio.sleep(0)     # Let the cancelled admissions finish
+            self.__scheduler.clear()
+            self.__executor.shutdown(wait=False)
+            self.__ordered_executor.shutdown(wait=True)
+            if self.__mosaic is not None:
+                self.__mosaic.close()
+            if self.__archive is not None:
+                self.__archive.close()
+                print("archive:", self.__archive.stats())
+            self.__sender.close()
+            if self.__pool is not None:
+                self.__pool.shutdown(wait=False)
+            self.__encoders.shutdown(wait=False)
+            if self.__ring is not None:
+                print("ring:", self.__ring.stats())
+                # Views of the slots may be kept alive by reference cycles, e.g. tracebacks of failed frames
+                gc.collect()
+                self.__ring.close()
+
+    def __connect(self):
+        parser = FrameParser(allocate=self.__ring.allocate if self.__ring is not None else allocate_image)
+        connection = DroneProtocol(parser, self.__admit, self.__connection_closed)
+        self.__connections.add(connection)
+        return connection
+
+    def __abort(self, parser):
+        # A slot allocated for an image which was not completely received is never handed to a worker
+        slot = parser.abort()
+        if slot is not None and self.__ring is not None:
+            self.__ring.release(slot)
+
+    def __connection_closed(self, connection, addr):
+        self.__connections.discard(connection)
+        self.__abort(connection.parser)
+        print("closing connection to", addr)
+        print("scheduler:", self.__scheduler.stats())
+        if self.__ring is not None:
+            print("ring:", self.__ring.stats())
+        print("encoder:", self.__encoders.stats())
+        print("sender:", self.__sender.stats())
+        if self.__gsd is not None:
+            print("gsd:", self.__gsd.stats())
+        if self.__coverage is not None:
+            print("coverage:", self.__coverage.stats())
+        print("buffers:", buffers.pool.stats())
+
+    async def __work(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            async with self.__ready:
+                await self.__ready.wait_for(lambda: len(self.__scheduler) > 0)
+                frame = self.__scheduler.pop()
+                self.__ready.notify_all()
+            if frame is None:   # Every pending frame was lagging
+                continue
+            orthophoto = None
+            try:
+                start_time = time.time()
+                multiplier = self.__gsd.multiplier(frame.task_id) if self.__gsd is not None else None
+                orthophoto = await self.__rectify(frame, multiplier)
+                if orthophoto is None:
+                    continue
+                print("Processing time:", format(time.time() - start_time, ".2f"))
+
+                # Results of a task arrive in order. Keep the order while encoding overlaps the next frames
+                sent = loop.create_future()
+                previous = self.__last_sent.get(frame.task_id)
+                self.__last_sent[frame.task_id] = sent
+                blended = None
+                try:
+                    if self.__pyramid is not None:
+                        await self.__send_tiles(frame, orthophoto, previous, multiplier, start_time)
+                    else:
+                        encoded = await asyncio.wrap_future(self.__encoders.submit(orthophoto.image))
+                        if self.__gsd is not None:
+                            self.__gsd.record(frame.task_id, multiplier, time.time() - start_time)
+                        if previous is not None:
+                            await previous
+                        self.__sender.submit(pack_packet(frame.frame_id, frame.task_id, frame.frame_id, 0,
+                                                         orthophoto.bbox_wkt, [], encoded,
+                                                         metadata=pipeline.orthophoto_metadata(orthophoto)))
+                    if self.__mosaic is not None:
+                        # Queued before the next frame of the task is sent, so it is blended after this one
+                        blended = loop.run_in_executor(self.__ordered_executor, self.__mosaic.add, frame.task_id,
+                                                       orthophoto)
+                finally:
+                    sent.set_result(None)
+                    if self.__last_sent.get(frame.task_id) is sent:
+                        del self.__last_sent[frame.task_id]
+                if blended is not None:
+                    await blended   # The orthophoto may be in a slot of the ring, released below
+                if self.__archive is not None:
+                    # Last, since the archive releases the orthophoto to the buffer pool once it is written
+                    await self.__submit_archive(frame, orthophoto)
+                    orthophoto = None
+                print("Elapsed time:", format(time.time() - start_time, ".2f"))
+            except Exception as e:
+                print(e)
+            finally:
+                pipeline.release(orthophoto)
+                self.__scheduler.complete(frame)
+                self.__release(frame)
+
+    async def __send_tiles(self, frame, orthophoto, previous, multiplier, start_time):
+        # Later frames of a task are drawn over earlier ones, so they are added to the pyramid in order
+        if previous is not None:
+            await previous
+        changed = await asyncio.get_event_loop().run_in_executor(self.__ordered_executor, self.__pyramid.add,
+                                                                 frame.task_id, orthophoto)
+        encoded = await asyncio.gather(*[asyncio.wrap_future(self.__encoders.submit(tile)) for _, tile in changed])
+        if self.__gsd is not None:
+            self.__gsd.record(frame.task_id, multiplier, time.time() - start_time)
+        for ((zoom, x, y), _), encoded_tile in zip(changed, encoded):
+            self.__sender.submit(pack_packet(frame.frame_id, frame.task_id, frame.frame_id, 0, tile_wkt(zoom, x, y),
+                                             [], encoded_tile, metadata={"tile": [zoom, x, y]}))
+
+    async def __submit_archive(self, frame, orthophoto):
+        if frame.slot is not None:
+            # The slot of the ring is released once the frame is sent, before the orthophoto is archived
+            image = buffers.pool.acquire(orthophoto.image.shape)
+            image[...] = orthophoto.image
+            pipeline.release(orthophoto)
+            orthophoto = orthophoto._replace(image=image)
+        if self.__archive.block:
+            await asyncio.get_event_loop().run_in_executor(self.__executor, self.__archive.submit, frame.task_id,
+                                                           frame.frame_id, orthophoto, pipeline.release)
+        else:
+            self.__archive.submit(frame.task_id, frame.frame_id, orthophoto, pipeline.release)
+
+    async def __admit(self, frame):
+        async with self.__ready:
+            if not self.__scheduler.max_pending:
+                # Without load shedding, wait here if the workers fall behind
+                await self.__ready.wait_for(lambda: len(self.__scheduler) < self.__work_queue_limit)
+            self.__scheduler.put(frame)
+            self.__ready.notify_all()
+
+    def __release(self, frame):
+        if frame.slot is not None:
+            self.__ring.release(frame.slot)
+
+    async def __rectify(self, frame, gsd_multiplier):
+        if self.__pool is None:
+            return await asyncio.get_event_loop().run_in_executor(self.__executor, pipeline.process, frame,
+                                                                  gsd_multiplier, self.__coverage)
+
+        # Georeference right away so that frames are submitted to the pool in the order they were queued
+        georeferenced = pipeline.georeference_frame(frame)
+        if georeferenced is None:
+            return
+        my_drone, adjusted_eo = georeferenced
+        admitted, crop = pipeline.admit(self.__coverage, frame.task_id, frame.image, my_drone, adjusted_eo)
+        if not admitted:
+            return
+        if frame.slot is None:
+            return await asyncio.wrap_future(self.__pool.rectify(frame.task_id, frame.image, my_drone, adjusted_eo,
+                                                                 gsd_multiplier, crop))
+
+        descriptor = self.__ring.descriptor(frame.slot, len(frame.image))
+        orthophoto = await asyncio.wrap_future(
+            self.__pool.submit(frame.task_id, rectify_slot, descriptor, my_drone, adjusted_eo, gsd_multiplier, crop))
+        if isinstance(orthophoto.image, tuple):     # Written to the output block of the slot
+            orthophoto = orthophoto._replace(image=self.__ring.output(frame.slot, orthophoto.image))
+        return orthophoto
+
+
+def serve(config):
+    """
+    Run the ingest server until interrupted
+    :param config: Parsed config.json
+    """
+    pipeline.configure(config)
+    try:
+        asyncio.run(IngestServer(config).serve_forever())
+    except KeyboardInterrupt:
+        print("caught keyboard interrupt, exiting")
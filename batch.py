@@ -0,0 +1,224 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+import geotiff
+import pipeline
+import projections
+from scheduler import summarize
+
+# An image to rectify offline
+#   name: A name of the output, unique in the batch | string
+#   path: A path of the encoded image | string
+#   camera: A model of the camera | string
+#   longitude, latitude, altitude, roll, pitch, yaw: Initial exterior orientation like that of a frame
+Job = namedtuple('Job', ['name', 'path', 'camera', 'longitude', 'latitude', 'altitude', 'roll', 'pitch', 'yaw'])
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff')
+
+
+def read_manifest(path):
+    """
+    Read the jobs of a CSV manifest with the columns image, camera, longitude, latitude, altitude, roll, pitch and yaw.
+    Paths of images are relative to the manifest.
+    :return: A list of Job
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='') as f:
+        return [Job(os.path.splitext(os.path.basename(row["image"]))[0], os.path.join(directory, row["image"]),
+                    row["camera"], float(row["longitude"]), float(row["latitude"]), float(row["altitude"]),
+                    float(row["roll"]), float(row["pitch"]), float(row["yaw"]))
+                for row in csv.DictReader(f)]
+
+
+def read_directory(directory):
+    """
+    Read the jobs of a directory of images, each with a JSON file of the same name holding the metadata of its frame
+    as a drone sends it, plus the position - longitude, latitude, altitude, roll, pitch, yaw and exif.Model
+    :return: A list of Job, sorted by the name of the image
+    """
+    jobs = []
+    for path in sorted(glob.glob(os.path.join(directory, "*"))):
+        stem, extension = os.path.splitext(path)
+        if extension.lower() not in IMAGE_EXTENSIONS or not os.path.exists(stem + ".json"):
+            continue
+        with open(stem + ".json") as f:
+            metadata = json.load(f)
+        jobs.append(Job(os.path.basename(stem), path, metadata["exif"]["Model"], metadata["longitude"],
+                        metadata["latitude"], metadata["altitude"], metadata["roll"], metadata["pitch"],
+                        metadata["yaw"]))
+    return jobs
+
+
+def read_jobs(path):
+    """
+    :param path: A directory of images, see read_directory(), or a CSV manifest, see read_manifest()
+    :return: A list of Job
+    """
+    return read_directory(path) if os.path.isdir(path) else read_manifest(path)
+
+
+def georeference_jobs(jobs):
+    """
+    Georeference the jobs of each camera at once
+    :return: A list of (Job, my_drone, adjusted_eo) of the jobs which can be rectified, in the order of jobs
+    """
+    columns = {}    # camera -> indices of its jobs
+    for i, job in enumerate(jobs):
+        columns.setdefault(job.camera, []).append(i)
+
+    georeferenced = [None] * len(jobs)
+    for camera, indices in columns.items():
+        eos = np.array([jobs[i][3:] for i in indices], dtype=float)
+        my_drone, adjusted_eos, rectifiable = pipeline.georeference_many(camera, *eos.T)
+        for i, adjusted_eo, ok in zip(indices, adjusted_eos, rectifiable):
+            if ok:
+                georeferenced[i] = (jobs[i], my_drone, adjusted_eo)
+    return [item for item in georeferenced if item is not None]
+
+
+def rectify_file(path, my_drone, adjusted_eo, dst, compress, block_size):
+    """
+    Rectify an image file to a Cloud Optimized GeoTIFF. Runs in a worker process.
+    The GeoTIFF is written to a temporary file and renamed, so readers never see a partial file.
+    :return: rectifiers.Orthophoto whose image is the shape of the orthophoto, and the seconds spent
+    """
+    start_time = time.time()
+    img = np.fromfile(path, dtype=np.uint8)
+    orthophoto = pipeline.rectify(img, my_drone, adjusted_eo)
+    try:
+        partial = dst + ".part"
+        geotiff.write_cog(partial, orthophoto.image, orthophoto.geotransform, projections.WEB_MERCATOR,
+                          compress, block_size)
+        os.replace(partial, dst)
+    finally:
+        pipeline.release(orthophoto)
+    return orthophoto._replace(image=orthophoto.image.shape), time.time() - start_time
+
+
+class BatchRectifier:
+    """
+    Rectify recorded frames offline, e.g. a whole flight, without the socket path.
+
+    Frames are georeferenced at once, then rectified and written as Cloud Optimized GeoTIFFs - directory/name.tif -
+    by worker processes, which read the images themselves. Only a few frames per process are in flight, so the memory
+    does not grow with the size of the batch. index.csv lists the orthophotos as they are written.
+    """
+    def __init__(self, config, directory, num_processes=None, queue_limit=2, compress="DEFLATE", block_size=512,
+                 progress_interval=5.0):
+        """
+        :param config: Parsed config.json to configure the pipeline of the worker processes
+        :param directory: The directory of the orthophotos
+        :param num_processes: The number of worker processes. If None, the number of CPUs is used
+        :param queue_limit: The maximum number of frames in flight per process
+        :param compress: Compression of the GeoTIFFs - DEFLATE, ZSTD, ...
+        :param block_size: The size of the tiles of the GeoTIFFs in pixels
+        :param progress_interval: Seconds between reports of the progress
+        """
+        self.config = config
+        self.directory = directory
+        self.num_processes = num_processes or os.cpu_count()
+        self.queue_limit = queue_limit
+        self.compress = compress
+        self.block_size = block_size
+        self.progress_interval = progress_interval
+        self.total = 0
+        self.written = 0
+        self.rejected = 0
+        self.failed = 0
+        self.__start_time = None
+        self.__frame_times = []
+
+    def run(self, jobs):
+        """
+        Rectify the jobs and wait until every orthophoto is written
+        :param jobs: A list of Job
+        """
+        self.__start_time = time.time()
+        self.total = len(jobs)
+        georeferenced = georeference_jobs(jobs)
+        self.rejected = len(jobs) - len(georeferenced)
+        print("batch: georeferenced %d frames in %.2f s, %d too tilted" %
+              (len(georeferenced), time.time() - self.__start_time, self.rejected))
+
+        os.makedirs(self.directory, exist_ok=True)
+        max_pending = self.num_processes * self.queue_limit
+        with ProcessPoolExecutor(max_workers=self.num_processes, initializer=pipeline.configure,
+                                 initargs=(self.config,)) as executor, \
+                open(os.path.join(self.directory, "index.csv"), "w", newline='') as index:
+            writer = csv.writer(index)
+            writer.writerow(["image", "orthophoto", "gsd", "boundary"])
+            pending = {}    # future -> job
+            last_report = time.time()
+            for job, my_drone, adjusted_eo in georeferenced:
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    self.__collect(done, pending, writer)
+                dst = os.path.join(self.directory, "%s.tif" % job.name)
+                future = executor.submit(rectify_file, job.path, my_drone, adjusted_eo, dst, self.compress,
+                                         self.block_size)
+                pending[future] = job
+                if time.time() - last_report >= self.progress_interval:
+                    self.__report()
+                    last_report = time.time()
+            while pending:
+                done, _ = wait(pending, timeout=self.progress_interval, return_when=FIRST_COMPLETED)
+                self.__collect(done, pending, writer)
+                self.__report()
+        print("batch:", self.stats())
+
+    def stats(self):
+        elapsed = time.time() - self.__start_time if self.__start_time is not None else 0.0
+        return {"total": self.total, "written": self.written, "rejected": self.rejected, "failed": self.failed,
+                "seconds": elapsed, "frames_per_second": self.written / elapsed if elapsed else None,
+                "frame": summarize(self.__frame_times)}
+
+    def __collect(self, done, pending, writer):
+        for future in done:
+            job = pending.pop(future)
+            try:
+                orthophoto, seconds = future.result()
+            except Exception as e:
+                self.failed += 1
+                print("batch:", job.path, e)
+                continue
+            self.written += 1
+            self.__frame_times.append(seconds)
+            writer.writerow([job.path, "%s.tif" % job.name, orthophoto.gsd, orthophoto.bbox_wkt])
+
+    def __report(self):
+        done = self.written + self.failed + self.rejected
+        elapsed = time.time() - self.__start_time
+        rate = self.written / elapsed if elapsed else 0.0
+        remaining = (self.total - done) / rate if rate else float('nan')
+        print("batch: %d/%d frames, %.1f frames/s, %.0f s left" % (done, self.total, rate, remaining))
+
+
+def create_batch_rectifier(config, directory):
+    """
+    Create a batch rectifier from the batch section of config.json
+    :param config: Parsed config.json
+    :param directory: The directory of the orthophotos
+    :return: BatchRectifier
+    """
+    batch = config.get("batch", {})
+    return BatchRectifier(config, directory, num_processes=batch.get("PROCESSES"),
+                          queue_limit=batch.get("QUEUE_LIMIT", 2), compress=batch.get("COMPRESS", "DEFLATE"),
+                          block_size=batch.get("BLOCK_SIZE", 512), progress_interval=batch.get("PROGRESS_INTERVAL", 5))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rectify recorded frames to Cloud Optimized GeoTIFFs")
+    parser.add_argument("frames", help="A directory of images with JSON metadata, or a CSV manifest")
+    parser.add_argument("output", help="The directory of the orthophotos")
+    parser.add_argument("--config", default="config.json", help="The configuration of the pipeline")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        data = json.load(f)
+    create_batch_rectifier(data, args.output).run(read_jobs(args.frames))
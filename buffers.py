@@ -0,0 +1,124 @@
+import threading
+import weakref
+from collections import defaultdict, deque
+import numpy as np
+
+
+def bucket_size(nbytes):
+    """
+    :return: The size of the buffers holding nbytes - 1, 1.25, 1.5 or 1.75 times a power of 2
+    """
+    if nbytes <= 4096:
+        return 4096
+    power = 1 << (int(nbytes - 1).bit_length() - 1)
+    for quarters in (4, 5, 6, 7, 8):
+        size = power * quarters // 4
+        if size >= nbytes:
+            return size
+
+
+class _CheckedOut(weakref.ref):
+    # Reference to a buffer checked out, which remembers its id and size after the buffer is collected
+    __slots__ = ("key", "size")
+
+
+class BufferPool:
+    """
+    Pool of reusable arrays in buckets of sizes, so that a long-running process reaches a steady state
+    where the large arrays of every frame - orthophotos and scratch arrays - are not allocated again.
+
+    acquire() checks out an array of any shape and dtype, and release() returns it.
+    An array which is never released is simply garbage collected.
+    Buffers of similar sizes share a bucket, so a buffer is at most 25% larger than the array.
+    """
+    def __init__(self, max_idle_bytes=256 * 1024 * 1024):
+        """
+        :param max_idle_bytes: The maximum memory of the buffers waiting to be reused. If 0, nothing is reused
+        """
+        self.max_idle_bytes = max_idle_bytes
+        self.hits = 0
+        self.misses = 0
+        self.high_water = 0     # The maximum memory of the buffers checked out at once
+        self.__lock = threading.Lock()
+        self.__idle = defaultdict(list)     # bucket size -> buffers waiting to be reused
+        self.__idle_bytes = 0
+        self.__checked_out = {}     # id -> _CheckedOut of the buffer checked out
+        self.__in_use_bytes = 0
+        # _CheckedOut of buffers collected without release. Appended by the garbage collector, so without the lock
+        self.__collected = deque()
+
+    def acquire(self, shape, dtype=np.uint8):
+        """
+        Check out an array. Its contents are undefined, like np.empty
+        :return: np.array of the shape and dtype
+        """
+        shape = tuple(int(n) for n in np.atleast_1d(shape))
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        size = bucket_size(nbytes)
+        with self.__lock:
+            idle = self.__idle.get(size)
+            if idle:
+                buffer = idle.pop()
+                self.__idle_bytes -= size
+                self.hits += 1
+            else:
+                buffer = None
+                self.misses += 1
+        if buffer is None:
+            buffer = np.empty(size, dtype=np.uint8)
+
+        checked_out = _CheckedOut(buffer, self.__collected.append)
+        checked_out.key = id(buffer)
+        checked_out.size = size
+        with self.__lock:
+            self.__drain_collected()
+            self.__checked_out[checked_out.key] = checked_out
+            self.__in_use_bytes += size
+            self.high_water = max(self.high_water, self.__in_use_bytes)
+        return buffer[:nbytes].view(dtype).reshape(shape)
+
+    def release(self, array):
+        """
+        Return an array from acquire(). Arrays from elsewhere are ignored
+        :return: False if the array is not from the pool
+        """
+        # Views of a buffer keep the buffer as their base
+        buffer = array
+        while buffer is not None and not self.__is_checked_out(buffer):
+            buffer = buffer.base if isinstance(buffer, np.ndarray) else None
+        if buffer is None:
+            return False
+
+        with self.__lock:
+            if self.__checked_out.pop(id(buffer), None) is None:
+                return False    # Released twice at once
+            self.__in_use_bytes -= buffer.nbytes
+            if self.__idle_bytes + buffer.nbytes <= self.max_idle_bytes:
+                self.__idle[buffer.nbytes].append(buffer)
+                self.__idle_bytes += buffer.nbytes
+        return True
+
+    def stats(self):
+        with self.__lock:
+            self.__drain_collected()
+            requests = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / requests if requests else None,
+                    "in_use_bytes": self.__in_use_bytes, "high_water_bytes": self.high_water,
+                    "idle_bytes": self.__idle_bytes}
+
+    def __is_checked_out(self, buffer):
+        checked_out = self.__checked_out.get(id(buffer))
+        return checked_out is not None and checked_out() is buffer
+
+    def __drain_collected(self):
+        # Buffers never released are garbage collected. Called with the lock held
+        while self.__collected:
+            checked_out = self.__collected.popleft()
+            if self.__checked_out.get(checked_out.key) is checked_out:
+                del self.__checked_out[checked_out.key]
+            self.__in_use_bytes -= checked_out.size
+
+
+# Pool of this process. See pipeline.configure()
+pool = BufferPool()
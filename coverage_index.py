@@ -0,0 +1,133 @@
+import threading
+import types
+import cv2
+import numpy as np
+
+NEVER = np.iinfo(np.int32).min
+
+
+class CoverageIndex:
+    """
+    Coverage of the recent footprints of each task, in a coarse occupancy grid in EPSG 3857.
+
+    Each cell keeps the number of the last frame which covered it. A cell is covered if one of the last
+    recent_frames frames of the task covered it, so a hovering drone still refreshes its orthophoto regularly.
+    Before a frame is rectified, the overlap of its footprint with the covered cells decides to
+      - skip the frame, if the overlap is at least skip_overlap
+      - rectify only the part of the orthophoto around the uncovered cells, if the overlap is at least crop_overlap
+      - rectify the whole frame, otherwise
+    """
+    def __init__(self, cell_size=2.0, recent_frames=20, skip_overlap=0.95, crop_overlap=0.5, chunk_size=256):
+        """
+        :param cell_size: The size of a cell in meter
+        :param recent_frames: The number of the latest frames of a task whose footprints are kept
+        :param skip_overlap: The overlap from which a frame is skipped. Over 1, frames are never skipped
+        :param crop_overlap: The overlap from which a frame is cropped. Over 1, frames are never cropped
+        :param chunk_size: Cells are allocated in chunks of chunk_size x chunk_size cells
+        """
+        self.cell_size = cell_size
+        self.recent_frames = recent_frames
+        self.skip_overlap = skip_overlap
+        self.crop_overlap = crop_overlap
+        self.chunk_size = chunk_size
+        self.__lock = threading.Lock()
+        self.__tasks = {}   # task id -> state of the task
+
+    def admit(self, task_id, footprint):
+        """
+        Decide how to rectify a frame and record its footprint
+        :param task_id: uuid of the task
+        :param footprint: Vertices of the footprint of the frame in EPSG 3857 | np.array of shape (n, 2)
+        :return: admitted, crop ... crop is the vertices of a convex polygon around the cells not covered yet
+                 in EPSG 3857 | np.array of shape (n, 2), or None to rectify the whole frame
+        """
+        # Footprint in cells. Rows of cells grow southward
+        cells = np.column_stack([footprint[:, 0], -footprint[:, 1]]) / self.cell_size
+        (col0, row0), (col1, row1) = np.floor(cells.min(axis=0)).astype(int), np.ceil(cells.max(axis=0)).astype(int)
+        mask = np.zeros((row1 - row0, col1 - col0), dtype=np.uint8)
+        vertices = cv2.convexHull(np.rint((cells - [col0, row0]) * 16).astype(np.int32))
+        cv2.fillConvexPoly(mask, vertices, 1, shift=4)
+        mask = mask.astype(bool)
+        if not mask.any():
+            return True, None
+
+        with self.__lock:
+            task = self.__tasks.get(task_id)
+            if task is None:
+                task = self.__tasks[task_id] = types.SimpleNamespace(frames=0, chunks={}, full=0, cropped=0,
+                                                                     skipped=0)
+            task.frames += 1
+            recent = self.__read(task, row0, col0, mask.shape) > task.frames - 1 - self.recent_frames
+            uncovered = mask & ~recent
+            overlap = 1 - uncovered.sum() / mask.sum()
+
+            if overlap >= self.skip_overlap:
+                task.skipped += 1
+                return False, None
+
+            crop = None
+            if overlap >= self.crop_overlap:
+                # Corners of the cells on the convex hull of the uncovered cells
+                rows, cols = np.nonzero(uncovered)
+                hull = cv2.convexHull(np.column_stack([cols, rows]).astype(np.int32)).reshape(-1, 2) + [col0, row0]
+                corners = (hull[:, None, :] + [[0, 0], [1, 0], [1, 1], [0, 1]]).reshape(-1, 2) * self.cell_size
+                crop = np.column_stack([corners[:, 0], -corners[:, 1]])
+                # The rest of the footprint keeps the age of the frames which covered it
+                mask = uncovered
+                task.cropped += 1
+            else:
+                task.full += 1
+            self.__write(task, row0, col0, mask, task.frames)
+            return True, crop
+
+    def stats(self):
+        """
+        :return: The number of frames rectified in full, cropped and skipped by task
+        """
+        with self.__lock:
+            return {str(task_id): {"full": task.full, "cropped": task.cropped, "skipped": task.skipped}
+                    for task_id, task in self.__tasks.items()}
+
+    def __chunks(self, row0, col0, shape):
+        # Chunks overlapping a window of cells, with the overlap in the window and in the chunk
+        size = self.chunk_size
+        for chunk_row in range(row0 // size, (row0 + shape[0] - 1) // size + 1):
+            for chunk_col in range(col0 // size, (col0 + shape[1] - 1) // size + 1):
+                top, left = max(row0, chunk_row * size), max(col0, chunk_col * size)
+                bottom = min(row0 + shape[0], (chunk_row + 1) * size)
+                right = min(col0 + shape[1], (chunk_col + 1) * size)
+                window = (slice(top - row0, bottom - row0), slice(left - col0, right - col0))
+                chunk = (slice(top - chunk_row * size, bottom - chunk_row * size),
+                         slice(left - chunk_col * size, right - chunk_col * size))
+                yield (chunk_row, chunk_col), window, chunk
+
+    def __read(self, task, row0, col0, shape):
+        seen = np.full(shape, NEVER, dtype=np.int32)
+        for key, window, chunk in self.__chunks(row0, col0, shape):
+            cells = task.chunks.get(key)
+            if cells is not None:
+                seen[window] = cells[chunk]
+        return seen
+
+    def __write(self, task, row0, col0, mask, frame):
+        for key, window, chunk in self.__chunks(row0, col0, mask.shape):
+            if not mask[window].any():
+                continue
+            cells = task.chunks.get(key)
+            if cells is None:
+                cells = task.chunks[key] = np.full((self.chunk_size, self.chunk_size), NEVER, dtype=np.int32)
+            cells[chunk][mask[window]] = frame
+
+
+def create_coverage_index(config):
+    """
+    Create a coverage index from the coverage section of config.json
+    :param config: Parsed config.json
+    :return: CoverageIndex ... or None if ENABLED is false
+    """
+    coverage = config.get("coverage", {})
+    if not coverage.get("ENABLED", False):
+        return None
+    return CoverageIndex(cell_size=coverage.get("CELL_SIZE", 2.0), recent_frames=coverage.get("RECENT_FRAMES", 20),
+                         skip_overlap=coverage.get("SKIP_OVERLAP", 0.95),
+                         crop_overlap=coverage.get("CROP_OVERLAP", 0.5))
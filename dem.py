@@ -0,0 +1,168 @@
+import os
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+from osgeo import gdal, osr
+import projections
+
+
+class ElevationModel:
+    """
+    A DEM read in square blocks, sampled in EPSG 3857.
+
+    The DEM is opened once. A block is decompressed the first time it is needed and stored as a raw float32 file
+    in the cache directory, which is memory-mapped from then on, also by the other processes sharing the directory.
+    The latest blocks used stay mapped in an LRU cache. Heights with no data are NaN.
+    """
+    def __init__(self, path, cache_directory="dem_cache", block_size=256, open_blocks=64):
+        """
+        :param path: A path of the DEM, e.g. a GeoTIFF. A DEM in another coordinate system is warped to EPSG 3857
+        :param cache_directory: The directory of the decompressed blocks
+        :param block_size: The size of a block in pixels
+        :param open_blocks: The maximum number of blocks kept mapped in memory
+        """
+        dataset = gdal.Open(path)
+        if dataset is None:
+            raise IOError("Failed to open the DEM: %s" % path)
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(dataset.GetProjection())
+        web_mercator = osr.SpatialReference()
+        web_mercator.ImportFromEPSG(projections.WEB_MERCATOR)
+        if not srs.IsSame(web_mercator):
+            dataset = gdal.Warp('', dataset, format='VRT', dstSRS='EPSG:%d' % projections.WEB_MERCATOR,
+                                resampleAlg='bilinear')
+
+        self.path = path
+        self.block_size = block_size
+        self.open_blocks = open_blocks
+        self.rows, self.cols = dataset.RasterYSize, dataset.RasterXSize
+        self.geotransform = dataset.GetGeoTransform()
+        gt = self.geotransform
+        # Ground coordinates relative to the origin -> (col, row) of the DEM
+        self.__inverse = np.linalg.inv(np.array([[gt[1], gt[2]], [gt[4], gt[5]]]))
+        self.hits = 0
+        self.maps = 0
+        self.reads = 0
+
+        self.__dataset = dataset
+        self.__band = dataset.GetRasterBand(1)
+        self.__nodata = self.__band.GetNoDataValue()
+        self.__directory = os.path.join(cache_directory, "%s_%d_%d" % (os.path.basename(path),
+                                                                        int(os.path.getmtime(path)), block_size))
+        os.makedirs(self.__directory, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__blocks = OrderedDict()   # (i, j) -> memmap, least recently used first
+
+    def sample(self, x, y):
+        """
+        Interpolate the heights at points
+        :param x, y: Coordinates of the points in EPSG 3857 | np.array
+        :return: Heights of the points, NaN out of the DEM | np.array of float32
+        """
+        cols, rows = self.__pixels(np.asarray(x, dtype=np.float64).ravel(), np.asarray(y, dtype=np.float64).ravel())
+        col0, row0 = int(np.floor(cols.min())), int(np.floor(rows.min()))
+        window = self.__window(row0, col0, int(np.floor(rows.max())) - row0 + 2, int(np.floor(cols.max())) - col0 + 2)
+        map_x = (cols - col0).astype(np.float32).reshape(1, -1)
+        map_y = (rows - row0).astype(np.float32).reshape(1, -1)
+        heights = cv2.remap(window, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT,
+                            borderValue=np.nan)
+        return heights.reshape(np.shape(x))
+
+    def grid(self, geotransform, rows, cols, out=None):
+        """
+        Interpolate the heights at the centers of the pixels of a grid, e.g. of an orthophoto
+        :param geotransform: GDAL geotransform of the grid in EPSG 3857
+        :param out: An array of float32 of shape (rows, cols) to hold the heights, e.g. from the buffer pool
+        :return: Heights, NaN out of the DEM | np.array of float32 of shape (rows, cols)
+        """
+        gt = geotransform
+        # Pixel of the grid -> ground coordinates. cv2 puts the centers of pixels at integers
+        grid_to_ground = np.array([[gt[1], gt[2], gt[0] + (gt[1] + gt[2]) / 2],
+                                   [gt[4], gt[5], gt[3] + (gt[4] + gt[5]) / 2],
+                                   [0, 0, 1]])
+        corners = np.dot(grid_to_ground, [[-1, cols, cols, -1], [-1, -1, rows, rows], [1, 1, 1, 1]])
+        dem_cols, dem_rows = self.__pixels(corners[0], corners[1])
+        col0, row0 = int(np.floor(dem_cols.min())) - 1, int(np.floor(dem_rows.min())) - 1
+        window = self.__window(row0, col0, int(np.ceil(dem_rows.max())) - row0 + 2,
+                               int(np.ceil(dem_cols.max())) - col0 + 2)
+
+        # Ground coordinates -> pixel of the window
+        dem = self.geotransform
+        ground_to_window = np.eye(3)
+        ground_to_window[0:2, 0:2] = self.__inverse
+        ground_to_window[0:2, 2] = -np.dot(self.__inverse, [dem[0], dem[3]]) - 0.5 - np.array([col0, row0])
+        M = np.dot(ground_to_window, grid_to_ground)[0:2]
+        return cv2.warpAffine(window, M, (cols, rows), dst=out, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=np.nan)
+
+    def stats(self):
+        return {"hits": self.hits, "maps": self.maps, "reads": self.reads}
+
+    def __pixels(self, x, y):
+        # cv2 coordinates of points in the DEM, whose pixel centers are at integers
+        cols, rows = np.dot(self.__inverse, [x - self.geotransform[0], y - self.geotransform[3]])
+        return cols - 0.5, rows - 0.5
+
+    def __window(self, row0, col0, rows, cols):
+        window = np.full((rows, cols), np.nan, dtype=np.float32)
+        size = self.block_size
+        with self.__lock:
+            for i in range(max(col0, 0) // size, min(col0 + cols, self.cols) // size + 1):
+                for j in range(max(row0, 0) // size, min(row0 + rows, self.rows) // size + 1):
+                    if i * size >= self.cols or j * size >= self.rows:
+                        continue
+                    block = self.__block(i, j)
+                    # Overlap of the block and the window in pixels of the DEM
+                    left, top = max(col0, i * size), max(row0, j * size)
+                    right, bottom = min(col0 + cols, (i + 1) * size), min(row0 + rows, (j + 1) * size)
+                    if left >= right or top >= bottom:
+                        continue
+                    window[top - row0:bottom - row0, left - col0:right - col0] = \
+                        block[top - j * size:bottom - j * size, left - i * size:right - i * size]
+        return window
+
+    def __block(self, i, j):
+        block = self.__blocks.get((i, j))
+        if block is not None:
+            self.hits += 1
+            self.__blocks.move_to_end((i, j))
+            return block
+
+        size = self.block_size
+        path = os.path.join(self.__directory, "%d_%d.f32" % (i, j))
+        if os.path.exists(path):
+            self.maps += 1
+        else:
+            # Decompress the block once. Other processes may do the same, so it is renamed into place
+            self.reads += 1
+            cols, rows = min(size, self.cols - i * size), min(size, self.rows - j * size)
+            heights = self.__band.ReadAsArray(i * size, j * size, cols, rows).astype(np.float32)
+            if self.__nodata is not None:
+                heights[heights == self.__nodata] = np.nan
+            partial = "%s.%d.part" % (path, os.getpid())
+            block = np.memmap(partial, dtype=np.float32, mode="w+", shape=(size, size))
+            block[...] = np.nan
+            block[0:rows, 0:cols] = heights
+            block.flush()
+            del block
+            os.replace(partial, path)
+        block = np.memmap(path, dtype=np.float32, mode="r", shape=(size, size))
+
+        self.__blocks[(i, j)] = block
+        while len(self.__blocks) > self.open_blocks:
+            self.__blocks.popitem(last=False)
+        return block
+
+
+def create_elevation_model(config):
+    """
+    Open the DEM of the dem section of config.json
+    :param config: Parsed config.json
+    :return: ElevationModel ... or None if PATH is empty
+    """
+    dem = config.get("dem", {})
+    if not dem.get("PATH"):
+        return None
+    return ElevationModel(dem["PATH"], cache_directory=dem.get("CACHE_DIRECTORY", "dem_cache"),
+                          block_size=dem.get("BLOCK_SIZE", 256), open_blocks=dem.get("OPEN_BLOCKS", 64))
@@ -5,6 +5,7 @@ import numpy as np
 
 class Drones:
     def __init__(self, make, ground_height=0.0, pre_calibrated=False):
+        self.make = make
         if make == "FC220":  # DJI Mavic Pro
             self.sensor_width = 6.3  # mm
             self.focal_length = 0.0047  # m
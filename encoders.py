@@ -0,0 +1,131 @@
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import cv2
+import buffers
+
+# An encoded orthophoto
+#   format: A name of the format | string
+#   parts: Bytes-like objects sent one after another as the image of a packet
+#   metadata: Items added to the metadata of the orthophoto | dict
+EncodedImage = namedtuple('EncodedImage', ['format', 'parts', 'metadata'])
+
+
+class BaseEncoder(ABC):
+    @abstractmethod
+    def encode(self, orthophoto):
+        """
+        Encode an orthophoto for transmission.
+
+        :param orthophoto: An orthophoto of 4 channels (BGRA) | np.array
+        :return: EncodedImage
+        """
+        raise NotImplementedError
+
+
+class PngEncoder(BaseEncoder):
+    def __init__(self, compression=1):
+        """
+        :param compression: Compression level of PNG from 0 (fastest) to 9 (smallest)
+        """
+        self.compression = compression
+
+    def encode(self, orthophoto):
+        _, png = cv2.imencode('.png', orthophoto, [cv2.IMWRITE_PNG_COMPRESSION, self.compression])
+        return EncodedImage('png', [memoryview(png)], {"img_format": "png"})
+
+
+class WebpEncoder(BaseEncoder):
+    def __init__(self, quality=80):
+        """
+        :param quality: Quality of WebP from 1 to 100. Over 100, lossless
+        """
+        self.quality = quality
+
+    def encode(self, orthophoto):
+        # WebP keeps the alpha channel
+        _, webp = cv2.imencode('.webp', orthophoto, [cv2.IMWRITE_WEBP_QUALITY, self.quality])
+        return EncodedImage('webp', [memoryview(webp)], {"img_format": "webp"})
+
+
+class JpegMaskEncoder(BaseEncoder):
+    def __init__(self, quality=90):
+        """
+        :param quality: Quality of JPEG from 0 to 100
+        """
+        self.quality = quality
+
+    def encode(self, orthophoto):
+        # JPEG has no alpha channel, so it is sent as a 1-bit PNG following the JPEG
+        # The intermediate images come from the buffer pool. cv2 allocates the encoded bytes itself
+        bgr = cv2.cvtColor(orthophoto, cv2.COLOR_BGRA2BGR, dst=buffers.pool.acquire(orthophoto.shape[0:2] + (3,)))
+        _, jpeg = cv2.imencode('.jpg', bgr, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        buffers.pool.release(bgr)
+        _, alpha = cv2.threshold(orthophoto[:, :, 3], 127, 255, cv2.THRESH_BINARY,
+                                 dst=buffers.pool.acquire(orthophoto.shape[0:2]))
+        _, mask = cv2.imencode('.png', alpha, [cv2.IMWRITE_PNG_BILEVEL, 1])
+        buffers.pool.release(alpha)
+        return EncodedImage('jpeg+mask', [memoryview(jpeg), memoryview(mask)],
+                            {"img_format": "jpeg+mask", "img_mask_length": len(mask)})
+
+
+def create_encoder(config):
+    """
+    Create an encoder from the encoder section of config.json
+    :param config: Parsed config.json
+    :return: BaseEncoder
+    """
+    encoder = config.get("encoder", {})
+    image_format = encoder.get("FORMAT", "png")
+    if image_format == "png":
+        return PngEncoder(encoder.get("PNG_COMPRESSION", 1))
+    elif image_format == "webp":
+        return WebpEncoder(encoder.get("WEBP_QUALITY", 80))
+    elif image_format == "jpeg+mask":
+        return JpegMaskEncoder(encoder.get("JPEG_QUALITY", 90))
+    raise ValueError("Unknown image format: %s" % image_format)
+
+
+class EncoderPool:
+    """
+    Encode orthophotos in worker threads, so encoding overlaps the rectification of the next frame.
+    cv2.imencode releases the GIL.
+    """
+    def __init__(self, encoder, num_workers=2):
+        self.encoder = encoder
+        self.__executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.__lock = threading.Lock()
+        self.__stats = {}   # format -> {"count", "bytes", "seconds"}
+
+    def submit(self, orthophoto):
+        """
+        :return: concurrent.futures.Future of EncodedImage
+        """
+        return self.__executor.submit(self.encode, orthophoto)
+
+    def encode(self, orthophoto):
+        start_time = time.time()
+        encoded = self.encoder.encode(orthophoto)
+        elapsed = time.time() - start_time
+
+        with self.__lock:
+            stats = self.__stats.setdefault(encoded.format, {"count": 0, "bytes": 0, "seconds": 0.0})
+            stats["count"] += 1
+            stats["bytes"] += sum(len(part) for part in encoded.parts)
+            stats["seconds"] += elapsed
+        return encoded
+
+    def stats(self):
+        """
+        :return: The number of orthophotos, mean size in bytes and mean time in seconds by format
+        """
+        with self.__lock:
+            return {image_format: {"count": stats["count"],
+                                   "mean_bytes": stats["bytes"] / stats["count"],
+                                   "mean_seconds": stats["seconds"] / stats["count"]}
+                    for image_format, stats in self.__stats.items()}
+
+    def shutdown(self, wait=True):
+        self.__executor.shutdown(wait=wait)
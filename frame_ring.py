@@ -0,0 +1,117 @@
+import threading
+from collections import deque, namedtuple
+from multiprocessing import shared_memory
+import numpy as np
+import pipeline
+
+# Small descriptor of a frame in the ring. Only this crosses the process boundary, not the image itself
+SlotDescriptor = namedtuple('SlotDescriptor', ['index', 'input_name', 'output_name', 'length', 'output_size'])
+
+_attached = {}  # name -> SharedMemory attached by this worker process
+
+
+class FrameRing:
+    """
+    Fixed-size ring of shared memory slots between the receiver and the rectifier workers.
+
+    Each slot has an input block, which receives the encoded image straight from the socket,
+    and an output block of the same index, to which a worker writes the orthophoto.
+    """
+    def __init__(self, num_slots, input_slot_size, output_slot_size):
+        """
+        :param num_slots: The number of slots
+        :param input_slot_size: The size of an input block in bytes ... the largest encoded image expected
+        :param output_slot_size: The size of an output block in bytes ... the largest orthophoto expected
+        """
+        self.num_slots = num_slots
+        self.input_slot_size = input_slot_size
+        self.output_slot_size = output_slot_size
+
+        self.__inputs = [shared_memory.SharedMemory(create=True, size=input_slot_size) for _ in range(num_slots)]
+        self.__outputs = [shared_memory.SharedMemory(create=True, size=output_slot_size) for _ in range(num_slots)]
+        self.__free = deque(range(num_slots))
+        self.__lock = threading.Lock()
+
+        self.acquired = 0
+        self.overflows = 0      # Frames which did not fit in the ring
+        self.high_water = 0
+
+    def allocate(self, length):
+        """
+        Acquire a slot for an image payload. Pass to socket_module.FrameParser as allocate.
+        :param length: The length of the payload in bytes
+        :return: (index of the slot, buffer) ... or (None, bytearray) if the ring is full or the payload is too large
+        """
+        with self.__lock:
+            if length > self.input_slot_size or not self.__free:
+                self.overflows += 1
+                return None, bytearray(length)
+            index = self.__free.popleft()
+            self.acquired += 1
+            self.high_water = max(self.high_water, self.num_slots - len(self.__free))
+        return index, self.__inputs[index].buf
+
+    def release(self, index):
+        with self.__lock:
+            self.__free.append(index)
+
+    def descriptor(self, index, length):
+        return SlotDescriptor(index, self.__inputs[index].name, self.__outputs[index].name, length,
+                              self.output_slot_size)
+
+    def output(self, index, shape):
+        """
+        :return: The orthophoto written to the output block of a slot, without copy
+        """
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.__outputs[index].buf)
+
+    def stats(self):
+        with self.__lock:
+            in_use = self.num_slots - len(self.__free)
+        return {"slots": self.num_slots, "in_use": in_use, "high_water": self.high_water,
+                "acquired": self.acquired, "overflows": self.overflows}
+
+    def close(self):
+        """
+        Close and unlink every slot. Drop the views of the slots first, e.g. the images of pending frames
+        """
+        exported = 0
+        for shm in self.__inputs + self.__outputs:
+            try:
+                shm.close()
+            except BufferError:
+                # A view of the slot is still alive. The memory is freed when the view is collected
+                exported += 1
+            finally:
+                shm.unlink()
+        if exported:
+            print("ring: %d shared memory blocks were still in use when closed" % exported)
+
+
+def attach(name):
+    shm = _attached.get(name)
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = shm
+    return shm
+
+
+def rectify_slot(descriptor, my_drone, adjusted_eo, gsd_multiplier=None, crop=None):
+    """
+    Rectify an image stored in a slot of a FrameRing. Runs in a worker process.
+    :param descriptor: SlotDescriptor of the slot
+    :param gsd_multiplier: See pipeline.rectify
+    :param crop: See pipeline.rectify
+    :return: rectifiers.Orthophoto whose image is the shape of the orthophoto written to the output block
+             ... or the orthophoto itself if it is larger than the output block
+    """
+    img = np.ndarray((descriptor.length,), dtype=np.uint8, buffer=attach(descriptor.input_name).buf)
+    orthophoto = pipeline.rectify(img, my_drone, adjusted_eo, gsd_multiplier, crop)
+    del img     # Do not keep the exported buffer alive
+
+    if orthophoto.image.nbytes > descriptor.output_size:
+        return orthophoto
+    output = np.ndarray(orthophoto.image.shape, dtype=np.uint8, buffer=attach(descriptor.output_name).buf)
+    output[...] = orthophoto.image
+    pipeline.release(orthophoto)
+    return orthophoto._replace(image=orthophoto.image.shape)
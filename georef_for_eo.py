@@ -19,6 +19,14 @@ class BaseGeoreferencer(ABC):
         """
         raise NotImplementedError
 
+    def georeference_many(self, my_drone, init_eos):
+        """
+        Georeference many images of a drone at once. Georeferencers with a closed form override it with array math.
+        :param init_eos: Initial exterior orientations | np.array of shape (n, 6)
+        :return: adjusted_eos | np.array of shape (n, 6)
+        """
+        return np.array([self.georeference(my_drone, np.array(init_eo, dtype=float)) for init_eo in init_eos])
+
 
 class DirectGeoreferencer(BaseGeoreferencer):
     def georeference(self, my_drone, init_eo):
@@ -31,6 +39,15 @@ class DirectGeoreferencer(BaseGeoreferencer):
         res = direct_georeferencer.georeference(my_drone, init_eo)
         return res
 
+    def georeference_many(self, my_drone, init_eos):
+        if my_drone.manufacturer == 'DJI':
+            direct_georeferencer = DirectGeoreferencerGimbalRPY()
+        elif my_drone.manufacturer == "Sandbox2020":
+            direct_georeferencer = DirectGeoreferencerSB20RPY()
+        else:
+            direct_georeferencer = DirectGeoreferencerFlightRPY()
+        return direct_georeferencer.georeference_many(my_drone, init_eos)
+
 
 class DirectGeoreferencerFlightRPY(BaseGeoreferencer):
     def georeference(self, my_drone, init_eo):
@@ -139,6 +156,15 @@ class DirectGeoreferencerGimbalRPY(BaseGeoreferencer):
         kappa = -gimbal_rpy[2]
         return np.array([float(omega_phi[0, 0]), float(omega_phi[1, 0]), kappa]) * np.pi / 180
 
+    def georeference_many(self, my_drone, init_eos):
+        # The same as __rpy_to_opk, with a column per angle
+        init_eos = np.asarray(init_eos, dtype=float)
+        roll, pitch, yaw = init_eos[:, 3], init_eos[:, 4], init_eos[:, 5]
+        roll_pitch = np.array([90 + pitch, np.where(roll < 0, 0, roll)])
+        omega_phi = np.einsum('ijn,jn->in', self.rot_2d(yaw * np.pi / 180), roll_pitch)
+        adjusted_opk = np.column_stack([omega_phi[0], omega_phi[1], -yaw]) * np.pi / 180
+        return np.column_stack([init_eos[:, :3], adjusted_opk])
+
     def rot_2d(self, theta):
         # Convert the coordinate system not coordinates
         return np.array([[np.cos(theta), np.sin(theta)],
@@ -162,6 +188,15 @@ class DirectGeoreferencerSB20RPY(BaseGeoreferencer):
         kappa = -yaw
         return np.array([float(omega_phi[0, 0]), float(omega_phi[1, 0]), kappa]) * np.pi / 180
 
+    def georeference_many(self, my_drone, init_eos):
+        # The same as __rpy_to_opk, with a column per angle
+        init_eos = np.asarray(init_eos, dtype=float)
+        roll, pitch, yaw = init_eos[:, 3], init_eos[:, 4], init_eos[:, 5] + 90
+        roll_pitch = np.array([pitch, roll])
+        omega_phi = np.einsum('ijn,jn->in', self.rot_2d(yaw * np.pi / 180), roll_pitch)
+        adjusted_opk = np.column_stack([omega_phi[0], omega_phi[1], -yaw]) * np.pi / 180
+        return np.column_stack([init_eos[:, :3], adjusted_opk])
+
     def rot_2d(self, theta):
         # Convert the coordinate system not coordinates
         return np.array([[np.cos(theta), np.sin(theta)],
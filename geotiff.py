@@ -0,0 +1,84 @@
+import numpy as np
+from osgeo import gdal, osr
+
+BGRA_BANDS = [3, 2, 1, 4]   # Bands of an RGBA GeoTIFF the channels of a BGRA image are written to
+
+
+def create_geotiff(dst, rows, cols, geotransform, epsg, options=None, driver='GTiff'):
+    """
+    Create a 4-band (RGB + Alpha) GeoTIFF to be written band by band or block by block
+    :param dst: A path of the GeoTIFF
+    :param geotransform: GDAL geotransform of the raster
+    :param epsg: EPSG code of the coordinate system of the geotransform | int
+    :param options: Creation options of the driver, e.g. ["TILED=YES"]
+    :param driver: GDAL driver, e.g. 'MEM' for a raster in memory
+    :return: gdal.Dataset ... close it by dropping the reference
+    """
+    # https://stackoverflow.com/questions/33537599/how-do-i-write-create-a-geotiff-rgb-image-file-in-python
+    # create the 4-band(RGB+Alpha) raster file
+    dst_ds = gdal.GetDriverByName(driver).Create(dst, cols, rows, 4, gdal.GDT_Byte, options or [])
+    dst_ds.SetGeoTransform(tuple(geotransform))  # specify coords
+
+    srs = osr.SpatialReference()  # establish encoding
+    srs.ImportFromEPSG(epsg)
+
+    dst_ds.SetProjection(srs.ExportToWkt())  # export coords to file
+    dst_ds.GetRasterBand(4).SetColorInterpretation(gdal.GCI_AlphaBand)
+    return dst_ds
+
+
+def write_bgra(dst_ds, image, x_offset=0, y_offset=0):
+    """
+    Write a BGRA image to the bands of an RGBA dataset in a single interleaved call
+    :param dst_ds: gdal.Dataset from create_geotiff
+    :param image: An image of 4 channels (BGRA) | np.array of uint8
+    :param x_offset, y_offset: The position of the image in the dataset in pixels
+    """
+    rows, cols = image.shape[0:2]
+    image = np.ascontiguousarray(image)
+    dst_ds.WriteRaster(x_offset, y_offset, cols, rows, image, buf_type=gdal.GDT_Byte, band_list=BGRA_BANDS,
+                       buf_pixel_space=4, buf_line_space=4 * cols, buf_band_space=1)
+
+
+def overview_levels(rows, cols, block_size):
+    """
+    :return: Decimation factors of the overviews, down to the size of a block
+    """
+    levels = []
+    factor = 2
+    while max(rows, cols) > block_size * factor // 2:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def write_cog(dst, image, geotransform, epsg, compress="DEFLATE", block_size=512, resampling="AVERAGE"):
+    """
+    Write a BGRA image to a Cloud Optimized GeoTIFF - tiled, compressed and with overviews
+    :param dst: A path of the GeoTIFF
+    :param image: An image of 4 channels (BGRA), e.g. an orthophoto | np.array of uint8
+    :param geotransform: GDAL geotransform of the image
+    :param epsg: EPSG code of the coordinate system of the geotransform | int
+    :param compress: DEFLATE, ZSTD, LZW, ...
+    :param block_size: The size of the tiles of the GeoTIFF in pixels
+    :param resampling: Resampling of the overviews
+    """
+    rows, cols = image.shape[0:2]
+    mem_ds = create_geotiff('', rows, cols, geotransform, epsg, driver='MEM')
+    write_bgra(mem_ds, image)
+
+    cog_driver = gdal.GetDriverByName('COG')
+    if cog_driver is not None:
+        options = ["COMPRESS=%s" % compress, "BLOCKSIZE=%d" % block_size, "OVERVIEWS=AUTO",
+                   "RESAMPLING=%s" % resampling]
+        dst_ds = cog_driver.CreateCopy(dst, mem_ds, options=options)
+    else:
+        # GDAL < 3.1 has no COG driver. Overviews built in memory are copied ahead of the full resolution
+        mem_ds.BuildOverviews(resampling, overview_levels(rows, cols, block_size))
+        options = ["TILED=YES", "BLOCKXSIZE=%d" % block_size, "BLOCKYSIZE=%d" % block_size,
+                   "COMPRESS=%s" % compress, "COPY_SRC_OVERVIEWS=YES"]
+        dst_ds = gdal.GetDriverByName('GTiff').CreateCopy(dst, mem_ds, options=options)
+    if dst_ds is None:
+        raise IOError("Failed to write %s" % dst)
+    dst_ds.FlushCache()  # write to disk
+    dst_ds = None
@@ -0,0 +1,96 @@
+import threading
+from collections import deque
+from scheduler import summarize
+
+
+class GsdController:
+    """
+    Adapt the gsd of orthophotos to hold the latency of rectification and encoding.
+
+    The cost of a frame grows with the number of pixels of its orthophoto, i.e. with (native gsd / gsd)^2.
+    For each task, the multiplier of the native gsd is raised when the 95th percentile of the latest latencies
+    exceeds the target, and lowered when it is well below the target, within [min_multiplier, max_multiplier].
+    """
+    def __init__(self, target, multiplier=2, min_multiplier=1, max_multiplier=8, step=1.25, window=20,
+                 headroom=0.6):
+        """
+        :param target: Target of the 95th percentile of latency in seconds
+        :param multiplier: The initial multiplier of each task
+        :param min_multiplier: The lower bound of the multiplier (finest orthophotos)
+        :param max_multiplier: The upper bound of the multiplier (coarsest orthophotos)
+        :param step: The ratio by which the multiplier is raised or lowered at once
+        :param window: The number of frames measured before the multiplier is adjusted again
+        :param headroom: The multiplier is lowered only if the 95th percentile is below headroom * target
+        """
+        if not 0 < min_multiplier <= multiplier <= max_multiplier:
+            raise ValueError("The multiplier must be within [min_multiplier, max_multiplier]")
+        self.target = target
+        self.initial_multiplier = multiplier
+        self.min_multiplier = min_multiplier
+        self.max_multiplier = max_multiplier
+        self.step = step
+        self.window = window
+        self.headroom = headroom
+
+        self.__lock = threading.Lock()
+        self.__tasks = {}   # task id -> (multiplier, deque of latencies measured with the multiplier)
+
+    def multiplier(self, task_id):
+        """
+        :return: The multiplier of the native gsd for the next frame of a task
+        """
+        with self.__lock:
+            multiplier, _ = self.__tasks.get(task_id, (self.initial_multiplier, None))
+            return multiplier
+
+    def record(self, task_id, multiplier, seconds):
+        """
+        Record the latency of a frame and adjust the multiplier of its task
+        :param multiplier: The multiplier the frame was rectified with
+        :param seconds: Time to rectify and encode the frame
+        """
+        with self.__lock:
+            current, latencies = self.__tasks.get(task_id, (self.initial_multiplier, None))
+            if latencies is None:
+                latencies = deque(maxlen=self.window)
+                self.__tasks[task_id] = (current, latencies)
+            if multiplier != current:
+                return  # Rectified before the last adjustment
+
+            latencies.append(seconds)
+            if len(latencies) < self.window:
+                return
+            p95 = summarize(latencies)["p95"]
+            if p95 > self.target:
+                adjusted = min(current * self.step, self.max_multiplier)
+            elif p95 < self.target * self.headroom:
+                adjusted = max(current / self.step, self.min_multiplier)
+            else:
+                return
+
+            if adjusted != current:
+                print("gsd multiplier of", task_id, ":", format(current, ".2f"), "->", format(adjusted, ".2f"),
+                      "(p95:", format(p95, ".2f"), "s)")
+                self.__tasks[task_id] = (adjusted, deque(maxlen=self.window))
+
+    def stats(self):
+        """
+        :return: The multiplier and the latency measured with it by task
+        """
+        with self.__lock:
+            return {str(task_id): {"multiplier": multiplier, "latency": summarize(latencies)}
+                    for task_id, (multiplier, latencies) in self.__tasks.items()}
+
+
+def create_gsd_controller(config):
+    """
+    Create a controller from the gsd section of config.json
+    :param config: Parsed config.json
+    :return: GsdController ... or None if ADAPTIVE is false
+    """
+    gsd = config.get("gsd", {})
+    if not gsd.get("ADAPTIVE", False):
+        return None
+    return GsdController(gsd["TARGET_P95_MS"] / 1000, multiplier=gsd.get("MULTIPLIER", 2),
+                         min_multiplier=gsd.get("MIN_MULTIPLIER", 1), max_multiplier=gsd.get("MAX_MULTIPLIER", 8),
+                         step=gsd.get("STEP", 1.25), window=gsd.get("WINDOW", 20))
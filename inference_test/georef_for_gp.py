@@ -1,6 +1,11 @@
+import os
+import sys
 import numpy as np
 from osgeo import ogr
-from osgeo.osr import SpatialReference, CoordinateTransformation
+
+# projections is at the root of the repository, also when run from inside inference_test
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import projections
 
 def Rot3D(eo):
     om = eo[3]
@@ -117,16 +122,6 @@ def create_inference_metadata(object_type, boundary_image, boundary_world):
 
 
 def geographic2plane(eo, epsg):
-    # Define the Plane Coordinate System (EPSG 5186)
-    plane = SpatialReference()
-    plane.ImportFromEPSG(epsg)
-
-    # Define the wgs84 system (EPSG 4326)
-    geographic = SpatialReference()
-    geographic.ImportFromEPSG(4326)
-
-    coord_transformation = CoordinateTransformation(geographic, plane)
-
-    # Check the transformation for a point close to the centre of the projected grid
-    xy = coord_transformation.TransformPoint(float(eo[0]), float(eo[1]))  # The order: Lon, Lat
-    return xy[0:2]
+    # Transformations are cached, and EPSG 3857 is computed in closed form
+    x, y = projections.transform(float(eo[0]), float(eo[1]), projections.WGS84, epsg)  # The order: Lon, Lat
+    return float(x), float(y)
@@ -1,16 +1,29 @@
 import socket
 import selectors
 import types
-from socket_module import receive, send
+from socket_module import FrameParser, read_frame, pack_packet
 import json
-import numpy as np
-import drones
-import georef_for_eo as georeferencers
-import rectifiers
+import pipeline
+import buffers
+import async_server
+from encoders import EncoderPool, create_encoder
+from senders import create_sender
+from scheduler import create_scheduler
+from gsd_controller import create_gsd_controller
+from tiles import create_tile_pyramid, tile_wkt
+from mosaic import create_mosaic
+from coverage_index import create_coverage_index
+from archive import create_archive_writer
 import time
 
 sel_server = selectors.DefaultSelector()
 sel_client = selectors.DefaultSelector()
+encoder = None
+gsd_controller = None
+pyramid = None
+mosaic = None
+coverage = None
+archive = None
 
 
 def accept_wrapper(sock):
@@ -18,8 +31,10 @@ def accept_wrapper(sock):
     print("accepted connection from", addr)
     # https://stackoverflow.com/questions/39145357/python-error-socket-error-errno-11-resource-temporarily-unavailable-when-s
     # conn.setblocking(False)
-    data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
-    events = selectors.EVENT_READ | selectors.EVENT_WRITE
+    # Frames wait in the scheduler while the connection keeps receiving, so every frame needs its own buffer
+    data = types.SimpleNamespace(addr=addr, parser=FrameParser(allocate=async_server.allocate_image))
+    # Only wait for incoming frames. A blocking socket is always writable, which made the loop spin
+    events = selectors.EVENT_READ
     sel_server.register(conn, events, data=data)
 
 
@@ -36,95 +51,179 @@ def start_connections(host, port, num_conns):
         sel_client.register(sock, events, data=data)
 
 
-def service_connection(key_s, mask_s, sock_c):
+def service_connection(key_s, mask_s, scheduler):
     sock_s = key_s.fileobj
     data_s = key_s.data
     if mask_s & selectors.EVENT_READ:
         try:
-            taskID, frameID, latitude, longitude, altitude, roll, pitch, yaw, camera, img = receive(sock_s)
-            if taskID is None:
+            frame = read_frame(sock_s, data_s.parser)
+            if frame is None:
                 print("No received data!!!")
+                print("closing connection to", data_s.addr)
+                print("scheduler:", scheduler.stats())
+                sel_server.unregister(sock_s)
+                sock_s.close()
                 return
-
-            start_time = time.time()
-            # 1. Set IO
-            my_drone = drones.Drones(make=camera, pre_calibrated=False)
-            # my_drone = drones.Drones(make=camera, ground_height=38.0, pre_calibrated=True)  # Only for test - Jeonju
-
-            # 2. System calibration & CCS converting
-            init_eo = np.array([longitude, latitude, altitude, roll, pitch, yaw])
-            if my_drone.pre_calibrated:
-                init_eo[3:] *= np.pi / 180
-                adjusted_eo = init_eo
-            else:
-                my_georeferencer = georeferencers.DirectGeoreferencer()
-                adjusted_eo = my_georeferencer.georeference(my_drone, init_eo)
-
-            if abs(adjusted_eo[3]) > 10 * np.pi / 180 or abs(adjusted_eo[4]) > 10 * np.pi / 180:    # Upper than 10 deg
-                print("Too much omega:", adjusted_eo[3] * 180/np.pi, " or phi:", adjusted_eo[4] * 180/np.pi)
-                return
-
-            # 3. Rectify
-            my_rectifier = rectifiers.AverageOrthoplaneRectifier(height=my_drone.ground_height)
-            bbox_wkt, orthophoto = my_rectifier.rectify(img, my_drone, adjusted_eo)
-            print("Processing time:", format(time.time() - start_time, ".2f"))
-
-            send(frameID, taskID, frameID, 0, bbox_wkt, [], orthophoto, sock_c)  # 메타데이터 생성/ send to client
-            print("Elapsed time:", format(time.time() - start_time, ".2f"))
+            scheduler.put(frame)
         except Exception as e:
             print(e)
             print("closing connection to", data_s.addr)
-            sock_c.close()
-            global client_connection
-            client_connection = 0
             sel_server.unregister(sock_s)
             sock_s.close()
 
 
-with open("config.json") as f:
-    data = json.load(f)
-
-### SERVER
-SERVER_PORT = data["server"]["PORT"]
-QUEUE_LIMIT = data["server"]["QUEUE_LIMIT"]     # 서버 대기 큐
-
-lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-# Avoid bind() exception: OSError: [Errno 48] Address already in use
-lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-lsock.bind(("", SERVER_PORT))
-lsock.listen()
-print("listening on", ("", SERVER_PORT))
-lsock.setblocking(False)
-sel_server.register(lsock, selectors.EVENT_READ, data=None)
-
-### CLIENT
-CLIENT_IP = data["client"]["IP"]
-CLIENT_PORT = data["client"]["PORT"]
-num_conn = data["client"]["NoC"]
-print('starting connection...')
-sock_client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-sock_client.connect_ex((CLIENT_IP, CLIENT_PORT))
-client_connection = 1
-print("Connected!")
-
-try:
-    while True:
-        events_servers = sel_server.select(timeout=None)
-        # events_clients = sel_client.select(timeout=None)
-        for key, mask in events_servers:
-            if key.data is None:
-                accept_wrapper(key.fileobj)
-            else:
-                service_connection(key, mask, sock_client)
-        # Check for a socket being monitored to continue
-        if client_connection == 0:
-            print('starting connection...')
-            sock_client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock_client.connect_ex((CLIENT_IP, CLIENT_PORT))
-            client_connection = 1
-            print("Connected!")
-except KeyboardInterrupt:
-    print("caught keyboard interrupt, exiting")
-finally:
-    sel_server.close()
-    sel_client.close()
+def process_frame(frame):
+    """
+    Rectify a frame and start encoding its orthophoto, or its tiles, in the encoder pool
+    :param frame: socket_module.Frame
+    :return: The frame being encoded, to be sent by deliver_frame() ... or None if it is rejected or failed
+    """
+    orthophoto = None
+    encoded = []
+    try:
+        start_time = time.time()
+        georeferenced = pipeline.georeference_frame(frame)
+        if georeferenced is None:
+            return
+        my_drone, adjusted_eo = georeferenced
+        admitted, crop = pipeline.admit(coverage, frame.task_id, frame.image, my_drone, adjusted_eo)
+        if not admitted:
+            print("Already covered:", frame.frame_id)
+            return
+
+        # 3. Rectify
+        multiplier = gsd_controller.multiplier(frame.task_id) if gsd_controller is not None else None
+        orthophoto = pipeline.rectify(frame.image, my_drone, adjusted_eo, multiplier, crop)
+        print("Processing time:", format(time.time() - start_time, ".2f"))
+
+        # 메타데이터 생성
+        if pyramid is not None:
+            # Only the tiles changed by the frame
+            images = [(tile_wkt(zoom, x, y), tile, {"tile": [zoom, x, y]})
+                      for (zoom, x, y), tile in pyramid.add(frame.task_id, orthophoto)]
+        else:
+            images = [(orthophoto.bbox_wkt, orthophoto.image, pipeline.orthophoto_metadata(orthophoto))]
+        # Encoded while the next frame is rectified
+        encoded = [encoder.submit(image) for _, image, _ in images]
+        if mosaic is not None:
+            mosaic.add(frame.task_id, orthophoto)
+        processed = types.SimpleNamespace(frame=frame, orthophoto=orthophoto, multiplier=multiplier,
+                                          start_time=start_time, images=images, encoded=encoded)
+        orthophoto = None
+        return processed
+    except Exception as e:
+        print(e)
+    finally:
+        if orthophoto is not None:
+            # Encoders may still read the orthophoto
+            for future in encoded:
+                future.exception()
+            pipeline.release(orthophoto)
+
+
+def deliver_frame(processed, sender):
+    """
+    Send a frame from process_frame() once it is encoded, and archive its orthophoto
+    """
+    frame, orthophoto = processed.frame, processed.orthophoto
+    try:
+        # send to client
+        packets = [pack_packet(frame.frame_id, frame.task_id, frame.frame_id, 0, wkt, [], future.result(),
+                               metadata=metadata)
+                   for (wkt, _, metadata), future in zip(processed.images, processed.encoded)]
+        if gsd_controller is not None:
+            gsd_controller.record(frame.task_id, processed.multiplier, time.time() - processed.start_time)
+        for packet in packets:
+            sender.submit(packet)
+        if archive is not None:
+            # The archive releases the orthophoto to the buffer pool once it is written
+            archive.submit(frame.task_id, frame.frame_id, orthophoto, pipeline.release)
+            orthophoto = None
+        print("Elapsed time:", format(time.time() - processed.start_time, ".2f"))
+    except Exception as e:
+        print(e)
+    finally:
+        for future in processed.encoded:
+            future.exception()  # Wait until the encoders no longer read the orthophoto
+        pipeline.release(orthophoto)
+
+
+def serve_selectors(data):
+    global encoder, gsd_controller, pyramid, mosaic, coverage, archive
+    pipeline.configure(data)
+    encoder = EncoderPool(create_encoder(data), num_workers=1)
+    gsd_controller = create_gsd_controller(data)
+    pyramid = create_tile_pyramid(data)
+    mosaic = create_mosaic(data)
+    coverage = create_coverage_index(data)
+    archive = create_archive_writer(data)
+
+    ### SERVER
+    SERVER_PORT = data["server"]["PORT"]
+    QUEUE_LIMIT = data["server"]["QUEUE_LIMIT"]     # 서버 대기 큐
+
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Avoid bind() exception: OSError: [Errno 48] Address already in use
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    lsock.bind(("", SERVER_PORT))
+    lsock.listen()
+    print("listening on", ("", SERVER_PORT))
+    lsock.setblocking(False)
+    sel_server.register(lsock, selectors.EVENT_READ, data=None)
+
+    ### CLIENT
+    # Connects in the background and reconnects whenever the connection is lost
+    sender = create_sender(data)
+
+    # Frames received while a frame is rectified wait here. Under overload, the latest frames win
+    scheduler = create_scheduler(data)
+
+    # A frame being encoded while the next one is rectified
+    processed = None
+    try:
+        while True:
+            # Receive the frames which have arrived, one pass over the ready connections, before rectifying the next
+            # one. A drone which streams without pause never keeps the loop from rectifying
+            events_servers = sel_server.select(timeout=0 if len(scheduler) or processed is not None else None)
+            # events_clients = sel_client.select(timeout=None)
+            for key, mask in events_servers:
+                if key.data is None:
+                    accept_wrapper(key.fileobj)
+                else:
+                    service_connection(key, mask, scheduler)
+
+            frame = scheduler.pop()
+            rectified = process_frame(frame) if frame is not None else None
+            if frame is not None and rectified is None:
+                scheduler.complete(frame)
+            # The previous frame has been encoded while this one was rectified
+            if processed is not None:
+                deliver_frame(processed, sender)
+                scheduler.complete(processed.frame)
+            processed = rectified
+    except KeyboardInterrupt:
+        print("caught keyboard interrupt, exiting")
+    finally:
+        if processed is not None:
+            deliver_frame(processed, sender)
+        sender.close()
+        if mosaic is not None:
+            mosaic.close()
+        if archive is not None:
+            archive.close()
+            print("archive:", archive.stats())
+        print("buffers:", buffers.pool.stats())
+        sel_server.close()
+        sel_client.close()
+
+
+if __name__ == "__main__":
+    with open("config.json") as f:
+        data = json.load(f)
+
+    # selectors: Process frames one by one in the select loop
+    # asyncio: Read every connection concurrently and process frames in executors
+    if data["server"].get("MODE", "selectors") == "asyncio":
+        async_server.serve(data)
+    else:
+        serve_selectors(data)
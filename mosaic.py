@@ -0,0 +1,282 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+import geotiff
+import projections
+from tiles import extent, unpremultiply, warp
+
+BLENDS = ("last", "feather")
+
+
+class MosaicCanvas:
+    """
+    Mosaic of the orthophotos of a task on a north-up grid in EPSG 3857.
+
+    The canvas is divided into fixed-size tiles, which are memory-mapped files allocated when first drawn,
+    so a large task never needs one array of the whole mosaic in memory.
+    Tile (i, j) covers x in [i * span, (i + 1) * span) and y in (-(j + 1) * span, -j * span], where span = size * gsd.
+    """
+    def __init__(self, directory, gsd, tile_size=512, blend="last", feather=32, open_tiles=256):
+        """
+        :param directory: The directory of the tiles of the canvas
+        :param gsd: Ground sampling distance of the canvas in meter
+        :param tile_size: The size of a tile in pixels
+        :param blend: 'last' draws the latest orthophoto over the canvas.
+                      'feather' averages orthophotos weighted by the distance from their edges
+        :param feather: The distance from the edge of an orthophoto where its weight reaches 1 in pixels
+        :param open_tiles: The maximum number of tiles kept mapped in memory
+        """
+        if blend not in BLENDS:
+            raise ValueError("Unknown blending: %s" % blend)
+        self.directory = directory
+        self.gsd = gsd
+        self.tile_size = tile_size
+        self.blend = blend
+        self.feather = feather
+        self.open_tiles = open_tiles
+
+        self.__lock = threading.RLock()
+        self.__tiles = OrderedDict()    # (i, j) -> (color, weight) memmaps, least recently used first
+        self.__allocated = set(self.__stored_tiles())
+
+    def add(self, orthophoto):
+        """
+        Blend an orthophoto into the canvas
+        :param orthophoto: rectifiers.Orthophoto in EPSG 3857
+        :return: Indices of the tiles drawn - list of (i, j)
+        """
+        image = orthophoto.image
+        weights = None
+        if self.blend == "feather":
+            # Distance from the nearest transparent pixel, i.e. the edge of the footprint
+            alpha = np.pad(image[:, :, 3], 1)
+            weights = cv2.distanceTransform(alpha, cv2.DIST_L2, 3)[1:-1, 1:-1]
+            weights = np.clip(weights / self.feather, 0, 1).astype(np.float32)
+
+        drawn = []
+        span = self.tile_size * self.gsd
+        xmin, ymin, xmax, ymax = extent(orthophoto.geotransform, *image.shape[0:2])
+        with self.__lock:
+            for i in range(int(np.floor(xmin / span)), int(np.floor(xmax / span)) + 1):
+                for j in range(int(np.floor(-ymax / span)), int(np.floor(-ymin / span)) + 1):
+                    if self.__draw(i, j, orthophoto, weights):
+                        drawn.append((i, j))
+        return drawn
+
+    def region(self, xmin, ymin, xmax, ymax):
+        """
+        Read a region of the canvas
+        :return: The region of 4 channels (BGRA) | np.array, and its geotransform
+        """
+        span = self.tile_size * self.gsd
+        col0, row0 = int(np.floor(xmin / self.gsd)), int(np.floor(-ymax / self.gsd))
+        col1, row1 = int(np.ceil(xmax / self.gsd)), int(np.ceil(-ymin / self.gsd))
+        region = np.zeros((row1 - row0, col1 - col0, 4), dtype=np.uint8)
+        with self.__lock:
+            for i in range(int(np.floor(xmin / span)), int(np.floor(xmax / span)) + 1):
+                for j in range(int(np.floor(-ymax / span)), int(np.floor(-ymin / span)) + 1):
+                    if (i, j) not in self.__allocated:
+                        continue
+                    color, _ = self.__tile(i, j)
+                    # Overlap of the tile and the region in pixels of the canvas
+                    left, top = max(col0, i * self.tile_size), max(row0, j * self.tile_size)
+                    right, bottom = min(col1, (i + 1) * self.tile_size), min(row1, (j + 1) * self.tile_size)
+                    if left >= right or top >= bottom:
+                        continue
+                    region[top - row0:bottom - row0, left - col0:right - col0] = \
+                        color[top - j * self.tile_size:bottom - j * self.tile_size,
+                              left - i * self.tile_size:right - i * self.tile_size]
+        return region, (col0 * self.gsd, self.gsd, 0, -row0 * self.gsd, 0, -self.gsd)
+
+    def snapshot(self, dst):
+        """
+        Write the whole canvas to a tiled GeoTIFF, one tile at a time
+        :param dst: A path of the GeoTIFF
+        :return: False if the canvas is empty
+        """
+        with self.__lock:
+            self.flush()
+            if not self.__allocated:
+                return False
+            (i0, j0), (i1, j1) = np.min(list(self.__allocated), axis=0), np.max(list(self.__allocated), axis=0)
+            size = self.tile_size
+            geotransform = (i0 * size * self.gsd, self.gsd, 0, -j0 * size * self.gsd, 0, -self.gsd)
+            dst_ds = geotiff.create_geotiff(dst, (j1 - j0 + 1) * size, (i1 - i0 + 1) * size, geotransform,
+                                            projections.WEB_MERCATOR,
+                                            ["TILED=YES", "BLOCKXSIZE=%d" % min(size, 512),
+                                             "BLOCKYSIZE=%d" % min(size, 512), "COMPRESS=DEFLATE"])
+            for i, j in sorted(self.__allocated):
+                color, _ = self.__tile(i, j)
+                x_offset, y_offset = int(i - i0) * size, int(j - j0) * size
+                geotiff.write_bgra(dst_ds, color, x_offset, y_offset)
+            dst_ds.FlushCache()  # write to disk
+            dst_ds = None
+        return True
+
+    def flush(self):
+        with self.__lock:
+            for color, weight in self.__tiles.values():
+                color.flush()
+                if weight is not None:
+                    weight.flush()
+
+    def close(self):
+        with self.__lock:
+            self.flush()
+            self.__tiles.clear()
+
+    def __draw(self, i, j, orthophoto, weights):
+        size = self.tile_size
+        xmin, ymax = i * size * self.gsd, -j * size * self.gsd
+        cut = warp(orthophoto.image, orthophoto.geotransform, xmin, ymax, self.gsd, (size, size))
+        # Pixels mostly inside the orthophoto are drawn
+        covered = cut[:, :, 3] >= 128
+        if not covered.any():
+            return False
+        cut = unpremultiply(cut.astype(np.float32))   # Transparent pixels are black, so the cut is premultiplied
+
+        color, weight = self.__tile(i, j)
+        if self.blend == "last":
+            color[covered, 0:3] = cut[covered, 0:3]
+        else:
+            # Running average weighted by the distance from the edges of the orthophotos
+            new_weight = warp(weights, orthophoto.geotransform, xmin, ymax, self.gsd, (size, size))[covered]
+            new_weight = np.maximum(new_weight, 1e-3)
+            old_weight = weight[covered]
+            total = old_weight + new_weight
+            color[covered, 0:3] = np.rint((color[covered, 0:3] * old_weight[:, None] +
+                                           cut[covered, 0:3] * new_weight[:, None]) / total[:, None])
+            weight[covered] = total
+        color[covered, 3] = 255
+        return True
+
+    def __tile(self, i, j):
+        tile = self.__tiles.get((i, j))
+        if tile is not None:
+            self.__tiles.move_to_end((i, j))
+            return tile
+
+        path = os.path.join(self.directory, "%d_%d" % (i, j))
+        mode = "r+" if (i, j) in self.__allocated else "w+"     # w+ allocates a tile of zeros (transparent)
+        color = np.memmap(path + ".bgra", dtype=np.uint8, mode=mode, shape=(self.tile_size, self.tile_size, 4))
+        weight = None
+        if self.blend == "feather":
+            mode = "r+" if os.path.exists(path + ".weight") else "w+"
+            weight = np.memmap(path + ".weight", dtype=np.float32, mode=mode, shape=(self.tile_size, self.tile_size))
+        self.__allocated.add((i, j))
+
+        self.__tiles[(i, j)] = tile = (color, weight)
+        while len(self.__tiles) > self.open_tiles:
+            _, (evicted_color, evicted_weight) = self.__tiles.popitem(last=False)
+            evicted_color.flush()
+            if evicted_weight is not None:
+                evicted_weight.flush()
+        return tile
+
+    def __stored_tiles(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(".bgra"):
+                i, j = name[:-len(".bgra")].split("_")
+                yield int(i), int(j)
+
+
+class Mosaic:
+    """
+    Live mosaics of tasks. Each task has its own MosaicCanvas in directory/task id
+    """
+    def __init__(self, directory, gsd=0, tile_size=512, blend="last", feather=32, open_tiles=256):
+        """
+        :param directory: The root directory of the canvases
+        :param gsd: Ground sampling distance of the canvases in meter. If 0, the gsd of the first orthophoto of a task
+        See MosaicCanvas for the other parameters
+        """
+        if blend not in BLENDS:
+            raise ValueError("Unknown blending: %s" % blend)
+        self.directory = directory
+        self.gsd = gsd
+        self.tile_size = tile_size
+        self.blend = blend
+        self.feather = feather
+        self.open_tiles = open_tiles
+        self.__lock = threading.Lock()
+        self.__canvases = {}    # task id -> MosaicCanvas
+
+    def add(self, task_id, orthophoto):
+        """
+        Blend an orthophoto into the mosaic of its task
+        :param task_id: uuid of the task
+        :param orthophoto: rectifiers.Orthophoto in EPSG 3857
+        :return: Indices of the tiles drawn
+        """
+        return self.canvas(task_id, orthophoto.gsd).add(orthophoto)
+
+    def canvas(self, task_id, gsd=None):
+        """
+        Get the canvas of a task. The canvas is created or reopened if needed
+        :param gsd: gsd of a new canvas if self.gsd is 0
+        :return: MosaicCanvas ... or None if it does not exist and gsd is None
+        """
+        with self.__lock:
+            canvas = self.__canvases.get(task_id)
+            if canvas is not None:
+                return canvas
+
+            directory = os.path.join(self.directory, str(task_id))
+            settings_path = os.path.join(directory, "mosaic.json")
+            if os.path.exists(settings_path):
+                # Keep drawing on the canvas left by a previous run
+                with open(settings_path) as f:
+                    settings = json.load(f)
+            elif gsd is not None:
+                settings = {"gsd": self.gsd or float(gsd), "tile_size": self.tile_size}
+                os.makedirs(directory, exist_ok=True)
+                with open(settings_path, "w") as f:
+                    json.dump(settings, f)
+            else:
+                return None
+
+            canvas = MosaicCanvas(directory, settings["gsd"], settings["tile_size"], self.blend, self.feather,
+                                  self.open_tiles)
+            self.__canvases[task_id] = canvas
+            return canvas
+
+    def region(self, task_id, xmin, ymin, xmax, ymax):
+        """
+        Read a region of the mosaic of a task in EPSG 3857
+        :return: The region of 4 channels (BGRA), and its geotransform ... or None if the task has no mosaic
+        """
+        canvas = self.canvas(task_id)
+        if canvas is None:
+            return None
+        return canvas.region(xmin, ymin, xmax, ymax)
+
+    def snapshot(self, task_id, dst):
+        """
+        Write the mosaic of a task to a tiled GeoTIFF
+        :return: False if the task has no mosaic
+        """
+        canvas = self.canvas(task_id)
+        return canvas is not None and canvas.snapshot(dst)
+
+    def close(self):
+        with self.__lock:
+            for canvas in self.__canvases.values():
+                canvas.close()
+            self.__canvases.clear()
+
+
+def create_mosaic(config):
+    """
+    Create a mosaic from the mosaic section of config.json
+    :param config: Parsed config.json
+    :return: Mosaic ... or None if ENABLED is false
+    """
+    mosaic = config.get("mosaic", {})
+    if not mosaic.get("ENABLED", False):
+        return None
+    return Mosaic(mosaic.get("DIRECTORY", "mosaic"), gsd=mosaic.get("GSD", 0), tile_size=mosaic.get("TILE_SIZE", 512),
+                  blend=mosaic.get("BLEND", "last"), feather=mosaic.get("FEATHER_PX", 32),
+                  open_tiles=mosaic.get("OPEN_TILES", 256))
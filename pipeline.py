@@ -0,0 +1,171 @@
+import numpy as np
+import drones
+import georef_for_eo as georeferencers
+import rectifiers
+import buffers
+from dem import create_elevation_model
+
+# Options of the rectifiers created by this process. See configure()
+rectifier_options = {}
+# DEM opened once by this process, or None to rectify onto the average height of the ground
+elevation_model = None
+
+
+def configure(config):
+    """
+    Apply the rectifier, gsd, dem and buffers sections of config.json to this process. Also used as the initializer of worker
+    processes.
+    :param config: Parsed config.json
+    """
+    rectifier = config.get("rectifier", {})
+    rectifier_options["method"] = rectifier.get("METHOD", "kernel")
+    rectifier_options["interpolation"] = rectifier.get("INTERPOLATION", "nearest")
+    rectifier_options["fixed_point_maps"] = rectifier.get("FIXED_POINT_MAPS", False)
+    rectifier_options["reduced_decode"] = rectifier.get("REDUCED_DECODE", True)
+    rectifier_options["grid"] = rectifier.get("GRID", "north")
+    strip_memory = rectifier.get("STRIP_MEMORY_MB", 64)
+    rectifier_options["strip_memory"] = int(strip_memory * 1024 * 1024) if strip_memory else None
+    rectifier_options["gsd_multiplier"] = config.get("gsd", {}).get("MULTIPLIER", 2)
+    rectifiers.geometry_cache.maxsize = rectifier.get("GEOMETRY_CACHE_SIZE", 8)
+    global elevation_model
+    elevation_model = create_elevation_model(config)
+    if elevation_model is not None and rectifier_options["method"] == "homography":
+        # The homography of a plane does not apply to a DEM. See rectifiers.DEMRectifier
+        print("The homography method needs a flat ground. Rectifying onto the DEM with the kernel method")
+        rectifier_options["method"] = "kernel"
+    max_idle = config.get("buffers", {}).get("MAX_IDLE_MB", 256)
+    buffers.pool.max_idle_bytes = int(max_idle * 1024 * 1024)
+
+
+def georeference(camera, longitude, latitude, altitude, roll, pitch, yaw):
+    """
+    Set the interior orientation of a camera and adjust the exterior orientation of an image
+    :param camera: A model of the camera | string
+    :return: my_drone, adjusted_eo ... or None if the image is too tilted to be rectified
+    """
+    # 1. Set IO
+    my_drone = drones.Drones(make=camera, pre_calibrated=False)
+    # my_drone = drones.Drones(make=camera, ground_height=38.0, pre_calibrated=True)  # Only for test - Jeonju
+
+    # 2. System calibration & CCS converting
+    init_eo = np.array([longitude, latitude, altitude, roll, pitch, yaw])
+    if my_drone.pre_calibrated:
+        init_eo[3:] *= np.pi / 180
+        adjusted_eo = init_eo
+    else:
+        my_georeferencer = georeferencers.DirectGeoreferencer()
+        adjusted_eo = my_georeferencer.georeference(my_drone, init_eo)
+
+    if abs(adjusted_eo[3]) > 10 * np.pi / 180 or abs(adjusted_eo[4]) > 10 * np.pi / 180:    # Upper than 10 deg
+        print("Too much omega:", adjusted_eo[3] * 180/np.pi, " or phi:", adjusted_eo[4] * 180/np.pi)
+        return
+
+    return my_drone, adjusted_eo
+
+
+def georeference_many(camera, longitude, latitude, altitude, roll, pitch, yaw):
+    """
+    Georeference many images of a camera at once, like georeference()
+    :param camera: A model of the camera | string
+    :param longitude, latitude, altitude, roll, pitch, yaw: A value per image | np.array
+    :return: my_drone, adjusted_eos | np.array of shape (n, 6), and whether each image can be rectified | np.array
+    """
+    my_drone = drones.Drones(make=camera, pre_calibrated=False)
+    init_eos = np.column_stack([longitude, latitude, altitude, roll, pitch, yaw]).astype(float)
+    if my_drone.pre_calibrated:
+        init_eos[:, 3:] *= np.pi / 180
+        adjusted_eos = init_eos
+    else:
+        my_georeferencer = georeferencers.DirectGeoreferencer()
+        adjusted_eos = my_georeferencer.georeference_many(my_drone, init_eos)
+
+    # Upper than 10 deg
+    rectifiable = (np.abs(adjusted_eos[:, 3]) <= 10 * np.pi / 180) & (np.abs(adjusted_eos[:, 4]) <= 10 * np.pi / 180)
+    return my_drone, adjusted_eos, rectifiable
+
+
+def rectify(img, my_drone, adjusted_eo, gsd_multiplier=None, crop=None):
+    """
+    Rectify an encoded image onto the average ground height of the drone
+    :param gsd_multiplier: The ratio of the gsd of the orthophoto to the native gsd. If None, the configured one
+    :param crop: Vertices of a polygon in EPSG 3857 to rectify around. If None, the whole image
+    :return: rectifiers.Orthophoto
+    """
+    options = dict(rectifier_options)
+    if gsd_multiplier is not None:
+        options["gsd_multiplier"] = gsd_multiplier
+    my_rectifier = create_rectifier(my_drone, options)
+    return my_rectifier.rectify_orthophoto(img, my_drone, adjusted_eo, crop)
+
+
+def release(orthophoto):
+    """
+    Return the image of an orthophoto to the buffer pool once it is encoded and archived
+    :param orthophoto: rectifiers.Orthophoto ... or None
+    """
+    if orthophoto is not None:
+        buffers.pool.release(orthophoto.image)
+
+
+def create_rectifier(my_drone, options):
+    """
+    :param options: Options of the rectifier, e.g. rectifier_options
+    :return: rectifiers.DEMRectifier if a DEM is configured, otherwise rectifiers.AverageOrthoplaneRectifier
+    """
+    if elevation_model is not None:
+        # The average height of the ground still fills the holes of the DEM
+        return rectifiers.DEMRectifier(elevation_model, height=my_drone.ground_height, **options)
+    return rectifiers.AverageOrthoplaneRectifier(height=my_drone.ground_height, **options)
+
+
+def admit(coverage, task_id, img, my_drone, adjusted_eo):
+    """
+    Check the footprint of an image against the coverage of its task, before it is decoded and rectified
+    :param coverage: coverage_index.CoverageIndex ... or None to rectify every image in full
+    :return: admitted, crop ... see coverage_index.CoverageIndex.admit
+    """
+    if coverage is None:
+        return True, None
+    my_rectifier = create_rectifier(my_drone, rectifier_options)
+    return coverage.admit(task_id, my_rectifier.footprint(img, my_drone, adjusted_eo))
+
+
+def orthophoto_metadata(orthophoto):
+    """
+    Describe the grid of an orthophoto for the metadata of its packet
+    :param orthophoto: rectifiers.Orthophoto
+    :return: gsd, rotation of the columns from the east in degrees (counterclockwise) and geotransform | dict
+    """
+    geotransform = orthophoto.geotransform
+    return {"gsd": orthophoto.gsd,
+            "rotation": float(np.degrees(np.arctan2(geotransform[4], geotransform[1]))),
+            "geotransform": [float(value) for value in geotransform]}
+
+
+def georeference_frame(frame):
+    """
+    Georeference a frame received from a drone
+    :param frame: socket_module.Frame
+    :return: my_drone, adjusted_eo ... or None if the image is too tilted to be rectified
+    """
+    return georeference(frame.metadata["exif"]["Model"], frame.longitude, frame.latitude, frame.altitude,
+                        frame.metadata["roll"], frame.metadata["pitch"], frame.metadata["yaw"])
+
+
+def process(frame, gsd_multiplier=None, coverage=None):
+    """
+    Georeference and rectify a frame received from a drone
+    :param frame: socket_module.Frame
+    :param gsd_multiplier: See rectify()
+    :param coverage: See admit()
+    :return: rectifiers.Orthophoto ... or None if the frame is rejected or already covered
+    """
+    georeferenced = georeference_frame(frame)
+    if georeferenced is None:
+        return
+
+    my_drone, adjusted_eo = georeferenced
+    admitted, crop = admit(coverage, frame.task_id, frame.image, my_drone, adjusted_eo)
+    if not admitted:
+        return
+    return rectify(frame.image, my_drone, adjusted_eo, gsd_multiplier, crop)
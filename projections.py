@@ -0,0 +1,85 @@
+import threading
+from copy import copy
+import numpy as np
+
+WGS84 = 4326
+WEB_MERCATOR = 3857
+EARTH_RADIUS = 6378137.0    # Semi-major axis of WGS84, m
+
+# CoordinateTransformation is not thread-safe, so every thread keeps its own cache
+_local = threading.local()
+
+
+def transformation(src_epsg, dst_epsg):
+    """
+    Get a coordinate transformation, which is created only once per thread
+    :param src_epsg: EPSG code of the source coordinate system | int
+    :param dst_epsg: EPSG code of the target coordinate system | int
+    :return: osr.CoordinateTransformation
+    """
+    cache = getattr(_local, "transformations", None)
+    if cache is None:
+        cache = _local.transformations = {}
+
+    key = (src_epsg, dst_epsg)
+    coord_transformation = cache.get(key)
+    if coord_transformation is None:
+        # GDAL is only needed for the transformations without a closed form, so the rectifiers do not depend on it
+        from osgeo import osr
+        from osgeo.osr import SpatialReference, CoordinateTransformation
+        src = SpatialReference()
+        src.ImportFromEPSG(src_epsg)
+        dst = SpatialReference()
+        dst.ImportFromEPSG(dst_epsg)
+        # GDAL 3 follows the axis order of the authority (Lat, Lon for EPSG 4326). Keep the order: Lon, Lat
+        if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+            src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        coord_transformation = CoordinateTransformation(src, dst)
+        cache[key] = coord_transformation
+    return coord_transformation
+
+
+def wgs84_to_web_mercator(lon, lat):
+    """
+    Closed-form transformation from WGS84 (EPSG 4326) to Web Mercator (EPSG 3857)
+    :param lon: Longitude in degree | float or array
+    :param lat: Latitude in degree | float or array
+    :return: x, y in meter
+    """
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def transform(x, y, src_epsg, dst_epsg):
+    """
+    Transform coordinates of many points in one call
+    :param x: x coordinates (Lon for EPSG 4326) | float or array
+    :param y: y coordinates (Lat for EPSG 4326) | float or array
+    :param src_epsg: EPSG code of the source coordinate system | int
+    :param dst_epsg: EPSG code of the target coordinate system | int
+    :return: x, y ... arrays of the same shape as the input
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if src_epsg == dst_epsg:
+        return x.copy(), y.copy()
+    if src_epsg == WGS84 and dst_epsg == WEB_MERCATOR:
+        return wgs84_to_web_mercator(x, y)
+
+    points = np.column_stack([x.ravel(), y.ravel()])
+    xyz = np.array(transformation(src_epsg, dst_epsg).TransformPoints(points.tolist()), dtype=float)
+    return xyz[:, 0].reshape(x.shape), xyz[:, 1].reshape(y.shape)
+
+
+def geographic2plane(eo, epsg):
+    """
+    Convert the position of exterior orientation from WGS84 to a plane coordinate system
+    :param eo: Exterior orientation - [Lon, Lat, height, omega, phi, kappa] | np.array
+    :param epsg: EPSG code of the plane coordinate system | int
+    :return: Converted exterior orientation - [X, Y, height, omega, phi, kappa]
+    """
+    eo_conv = copy(eo)
+    eo_conv[0], eo_conv[1] = transform(float(eo[0]), float(eo[1]), WGS84, epsg)
+    return eo_conv
@@ -1,12 +1,134 @@
 from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+import threading
 import time
+import types
 import cv2
-from osgeo.osr import SpatialReference, CoordinateTransformation
-from copy import copy
 import numpy as np
-from numba import jit
-from osgeo import gdal, osr, ogr
+from numba import jit, prange
 import logging
+import projections
+import buffers
+
+INTERPOLATIONS = {
+    'nearest': cv2.INTER_NEAREST,
+    'bilinear': cv2.INTER_LINEAR,
+    'bicubic': cv2.INTER_CUBIC,
+    'area': cv2.INTER_AREA
+}
+
+
+class GeometryCache:
+    """
+    LRU cache of the geometry of cameras, which does not change between frames of a camera
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, create):
+        """
+        :param key: (model of the camera, image rows, image cols)
+        :param create: A function which computes the geometry if it is not cached
+        """
+        with self.__lock:
+            geometry = self.__entries.get(key)
+            if geometry is not None:
+                self.hits += 1
+                self.__entries.move_to_end(key)
+                return geometry
+            self.misses += 1
+
+        geometry = create()
+        with self.__lock:
+            self.__entries[key] = geometry
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+        return geometry
+
+
+geometry_cache = GeometryCache()
+
+# A rectified image
+#   bbox_wkt: Boundary of the orthophoto | string in wkt
+#   image: Orthophoto of 4 channels (BGRA) | np.array
+#   geotransform: GDAL geotransform of the orthophoto in EPSG 3857 | np.array
+#   gsd: Ground sampling distance of the orthophoto in meter | float
+Orthophoto = namedtuple('Orthophoto', ['bbox_wkt', 'image', 'geotransform', 'gsd'])
+
+# Memory of the intermediate arrays of a pixel of the orthophoto by the method, in bytes.
+# remap: projected coordinates (3 x float64), coordinates in the camera coordinate system (3 x float64),
+#        scale, plane and pixel coordinates (5 x float64), back-projected coordinates (2 x float64),
+#        maps (2 x float32) and heights of the ground
+STRIP_BYTES_PER_PIXEL = {
+    'kernel': 8,
+    'remap': 128
+}
+
+# cv2.remap and cv2.warpPerspective only write destinations of fewer rows and columns than SHRT_MAX
+WARP_MAX_SIZE = 32766
+
+# Decoding flags of cv2.imdecode by the reduction of the resolution
+REDUCED_DECODES = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+
+def jpeg_size(img):
+    """
+    Read the size of a JPEG image from its header without decoding it
+    :param img: Encoded image | np.array of uint8
+    :return: (rows, cols) ... or None if it is not a JPEG image
+    """
+    data = memoryview(img).cast('B')
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:    # SOI
+        return None
+
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:  # Fill byte
+            i += 1
+            continue
+        # SOF0-SOF15 except DHT(C4), JPG(C8) and DAC(CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            rows = (data[i + 5] << 8) + data[i + 6]
+            cols = (data[i + 7] << 8) + data[i + 8]
+            return rows, cols
+        i += 2 + (data[i + 2] << 8) + data[i + 3]
+    return None
+
+
+def png_size(img):
+    """
+    Read the size of a PNG image from its IHDR chunk without decoding it
+    :param img: Encoded image | np.array of uint8
+    :return: (rows, cols) ... or None if it is not a PNG image
+    """
+    data = memoryview(img).cast('B')
+    if len(data) < 24 or bytes(data[:8]) != b'\x89PNG\r\n\x1a\n' or bytes(data[12:16]) != b'IHDR':
+        return None
+    cols = int.from_bytes(data[16:20], 'big')
+    rows = int.from_bytes(data[20:24], 'big')
+    return rows, cols
+
+
+def encoded_image_size(img):
+    """
+    Read the size of an encoded image from its header without decoding it
+    :param img: Encoded image | np.array of uint8
+    :return: (rows, cols) ... or None if it is neither a JPEG nor a PNG image
+    """
+    size = jpeg_size(img)
+    return size if size is not None else png_size(img)
 
 
 class BaseRectifier(ABC):
@@ -38,6 +160,40 @@ class BaseRectifier(ABC):
 
 
 class AverageOrthoplaneRectifier(BaseRectifier):
+    def __init__(self, height, gsd='auto', method='kernel', interpolation='nearest', fixed_point_maps=False,
+                 reduced_decode=True, gsd_multiplier=2, grid='north', strip_memory=None):
+        """
+        Initialize rectifier.
+        :param height: Average height of the ground (float).
+        :param gsd: Desired ground sampling distance in meter. If 'auto', rectifier will automatically compute gsd.
+        :param method: 'kernel' back-projects every pixel of the orthophoto in a numba kernel.
+                       'homography' warps the image with the homography between the image and the plane.
+                       'remap' back-projects every pixel of the orthophoto and resamples the image with cv2.remap.
+        :param interpolation: Interpolation of the homography and remap methods - nearest, bilinear, bicubic or area.
+                              The kernel method always uses the nearest neighbor. cv2.remap treats area as bilinear.
+        :param fixed_point_maps: If True, convert the maps of the remap method to fixed-point (CV_16SC2) maps.
+        :param reduced_decode: If True, decode JPEG images at 1/2, 1/4 or 1/8 of the resolution
+                               when the orthophoto does not need the full resolution.
+        :param gsd_multiplier: The ratio of the automatic gsd to the native gsd of each image.
+        :param grid: 'north' rectifies onto a north-up grid covering the bounding box of the footprint.
+                     'heading' rectifies onto a grid rotated to the minimum-area rectangle of the footprint,
+                     which has less transparent padding when the heading is diagonal.
+        :param strip_memory: The kernel and remap methods rectify the orthophoto in strips of rows whose intermediate
+                             arrays take at most about strip_memory bytes. If None, the whole orthophoto at once.
+        """
+        super().__init__(height, gsd)
+        if method not in ('kernel', 'homography', 'remap'):
+            raise ValueError("Unknown rectification method: %s" % method)
+        if grid not in ('north', 'heading'):
+            raise ValueError("Unknown grid: %s" % grid)
+        self.method = method
+        self.interpolation = INTERPOLATIONS[interpolation]
+        self.fixed_point_maps = fixed_point_maps
+        self.reduced_decode = reduced_decode
+        self.gsd_multiplier = gsd_multiplier
+        self.grid = grid
+        self.strip_memory = strip_memory
+
     def __restoreOrientation(self, image, orientation):
         if orientation == 8:
             restored_image = self.__rotate(image, -90)
@@ -77,21 +233,8 @@ class AverageOrthoplaneRectifier(BaseRectifier):
         return rotated_mat
 
     def __geographic2plane(self, eo, epsg):
-        # Define the Plane Coordinate System (EPSG 5186)
-        plane = SpatialReference()
-        plane.ImportFromEPSG(epsg)
-
-        # Define the wgs84 system (EPSG 4326)
-        geographic = SpatialReference()
-        geographic.ImportFromEPSG(4326)
-
-        coord_transformation = CoordinateTransformation(geographic, plane)
-
-        # Check the transformation for a point close to the centre of the projected grid
-        xy = coord_transformation.TransformPoint(float(eo[0]), float(eo[1]))  # The order: Lon, Lat
-        eo_conv = copy(eo)
-        eo_conv[0:2] = xy[0:2]
-        return eo_conv
+        # Transformations are cached, and EPSG 3857 is computed in closed form
+        return projections.geographic2plane(eo, epsg)
 
     def __Rot3D(self, eo):
         om = eo[3]
@@ -141,11 +284,9 @@ class AverageOrthoplaneRectifier(BaseRectifier):
         R = np.linalg.multi_dot([Rz, Ry, Rx])
         return R
 
-    def __boundary(self, image, eo, R, dem, pixel_size, focal_length):
+    def __boundary(self, image_vertex, eo, R, dem):
         inverse_R = R.transpose()
 
-        image_vertex = self.__getVertices(image, pixel_size, focal_length)  # shape: 3 x 4
-
         proj_coordinates = self.__projection(image_vertex, eo, inverse_R, dem)
 
         bbox = np.empty(shape=(4, 1))
@@ -156,10 +297,7 @@ class AverageOrthoplaneRectifier(BaseRectifier):
 
         return bbox, proj_coordinates.T
 
-    def __getVertices(self, image, pixel_size, focal_length):
-        rows = image.shape[0]
-        cols = image.shape[1]
-
+    def __getVertices(self, rows, cols, pixel_size, focal_length):
         # (1) ------------ (2)
         #  |     image      |
         #  |                |
@@ -193,130 +331,428 @@ class AverageOrthoplaneRectifier(BaseRectifier):
 
     @staticmethod
     @jit(nopython=True)
-    def __projectedCoord(boundary, boundary_rows, boundary_cols, gsd, eo, ground_height):
-        proj_coords = np.empty(shape=(3, boundary_rows * boundary_cols))
+    def __projectedCoord(geotransform, first_row, boundary_rows, boundary_cols, eo, heights, proj_coords):
+        # Rows [first_row, first_row + boundary_rows) of the grid, into proj_coords of shape (3, rows x cols)
         i = 0
         for row in range(boundary_rows):
+            grid_row = first_row + row
             for col in range(boundary_cols):
-                proj_coords[0, i] = boundary[0, 0] + col * gsd - eo[0]
-                proj_coords[1, i] = boundary[3, 0] - row * gsd - eo[1]
+                proj_coords[0, i] = geotransform[0] + col * geotransform[1] + grid_row * geotransform[2] - eo[0]
+                proj_coords[1, i] = geotransform[3] + col * geotransform[4] + grid_row * geotransform[5] - eo[1]
+                proj_coords[2, i] = heights[row, col] - eo[2]
                 i += 1
-        proj_coords[2, :] = ground_height - eo[2]
         return proj_coords
 
     def __backProjection(self, coord, R, focal_length, pixel_size, image_size):
-        coord_CCS_m = np.dot(R, coord)  # unit: m     3 x (row x col)
-        scale = (coord_CCS_m[2]) / (-focal_length)  # 1 x (row x col)
-        plane_coord_CCS = coord_CCS_m[0:2] / scale  # 2 x (row x col)
+        # Computed in place in an array of the buffer pool, which the caller releases
+        coord_CCS_m = buffers.pool.acquire(coord.shape, np.float64)
+        np.dot(R, coord, out=coord_CCS_m)  # unit: m     3 x (row x col)
+        scale = coord_CCS_m[2]
+        scale /= -focal_length  # 1 x (row x col)
+        plane_coord_CCS = coord_CCS_m[0:2]
+        plane_coord_CCS /= scale  # 2 x (row x col)
         logging.debug(plane_coord_CCS.shape)
         logging.debug(pixel_size)
         # Convert CCS to Pixel Coordinate System
-        coord_CCS_px = plane_coord_CCS / pixel_size  # unit: px
-        coord_CCS_px[1] = -coord_CCS_px[1]
+        coord_CCS_px = plane_coord_CCS
+        coord_CCS_px /= pixel_size  # unit: px
+        coord_CCS_px[1] *= -1
 
-        coord_out = image_size[::-1] / 2 + coord_CCS_px  # 2 x (row x col)
+        coord_CCS_px += image_size[::-1] / 2  # 2 x (row x col)
 
-        return coord_out
+        return coord_CCS_px
 
     @staticmethod
-    @jit(nopython=True)
-    def __resample(coord, boundary_rows, boundary_cols, image):
-        # Define channels of an orthophoto
-        b = np.zeros(shape=(boundary_rows, boundary_cols), dtype=np.uint8)
-        g = np.zeros(shape=(boundary_rows, boundary_cols), dtype=np.uint8)
-        r = np.zeros(shape=(boundary_rows, boundary_cols), dtype=np.uint8)
-        a = np.zeros(shape=(boundary_rows, boundary_cols), dtype=np.uint8)
-
-        rows = np.reshape(coord[1], (boundary_rows, boundary_cols))
-        cols = np.reshape(coord[0], (boundary_rows, boundary_cols))
-
-        rows = rows.astype(np.int16)
-        # rows = np.int16(rows)
-        cols = cols.astype(np.int16)
-
-        for row in range(boundary_rows):
+    @jit(nopython=True, parallel=True)
+    def __rectifyKernel(geotransform, first_row, boundary_rows, boundary_cols, eo, heights, R, focal_length,
+                        pixel_size, image, orthophoto):
+        # Project, back-project and resample every pixel of rows [first_row, first_row + boundary_rows) of the grid
+        # in a single pass without creating any intermediate array of the size of the orthophoto
+        image_rows = image.shape[0]
+        image_cols = image.shape[1]
+
+        for row in prange(boundary_rows):
+            grid_row = first_row + row
             for col in range(boundary_cols):
-                if cols[row, col] < 0 or cols[row, col] >= image.shape[1]:
-                    continue
-                elif rows[row, col] < 0 or rows[row, col] >= image.shape[0]:
-                    continue
+                # Ground coordinates relative to the perspective center
+                dx = geotransform[0] + col * geotransform[1] + grid_row * geotransform[2] - eo[0]
+                dy = geotransform[3] + col * geotransform[4] + grid_row * geotransform[5] - eo[1]
+                dz = heights[row, col] - eo[2]
+
+                # Camera coordinate system
+                x_ccs = R[0, 0] * dx + R[0, 1] * dy + R[0, 2] * dz
+                y_ccs = R[1, 0] * dx + R[1, 1] * dy + R[1, 2] * dz
+                z_ccs = R[2, 0] * dx + R[2, 1] * dy + R[2, 2] * dz
+                scale = z_ccs / (-focal_length)
+
+                # Pixel coordinate system
+                col_px = image_cols / 2 + (x_ccs / scale) / pixel_size
+                row_px = image_rows / 2 - (y_ccs / scale) / pixel_size
+
+                if col_px <= -1 or col_px >= image_cols or row_px <= -1 or row_px >= image_rows:
+                    orthophoto[row, col, 0] = 0
+                    orthophoto[row, col, 1] = 0
+                    orthophoto[row, col, 2] = 0
+                    orthophoto[row, col, 3] = 0
                 else:
-                    b[row, col] = image[rows[row, col], cols[row, col]][0]
-                    g[row, col] = image[rows[row, col], cols[row, col]][1]
-                    r[row, col] = image[rows[row, col], cols[row, col]][2]
-                    a[row, col] = 255
-
-        return b, g, r, a
+                    # Truncate toward zero to pick the nearest neighbor
+                    image_row = int(row_px)
+                    image_col = int(col_px)
+                    orthophoto[row, col, 0] = image[image_row, image_col, 0]
+                    orthophoto[row, col, 1] = image[image_row, image_col, 1]
+                    orthophoto[row, col, 2] = image[image_row, image_col, 2]
+                    orthophoto[row, col, 3] = 255
 
-    def __createGeoTiff(self, b, g, r, a, boundary, gsd, rows, cols, dst):
-        # https://stackoverflow.com/questions/33537599/how-do-i-write-create-a-geotiff-rgb-image-file-in-python
-        geotransform = (boundary[0], gsd, 0, boundary[3], 0, -gsd)
+        return orthophoto
 
-        # create the 4-band(RGB+Alpha) raster file
-        dst_ds = gdal.GetDriverByName('GTiff').Create(dst, cols, rows, 4, gdal.GDT_Byte)
-        dst_ds.SetGeoTransform(geotransform)  # specify coords
-
-        # Define the TM central coordinate system (EPSG 5186)
-        srs = osr.SpatialReference()  # establish encoding
-        srs.ImportFromEPSG(5186)
+    def __cameraGeometry(self, my_drone, image_rows, image_cols):
+        pixel_size = my_drone.sensor_width / image_cols  # unit: mm/px
+        pixel_size = pixel_size / 1000  # unit: m/px
 
-        dst_ds.SetProjection(srs.ExportToWkt())  # export coords to file
-        dst_ds.GetRasterBand(1).WriteArray(r)  # write r-band to the raster
-        dst_ds.GetRasterBand(2).WriteArray(g)  # write g-band to the raster
-        dst_ds.GetRasterBand(3).WriteArray(b)  # write b-band to the raster
-        dst_ds.GetRasterBand(4).WriteArray(a)  # write a-band to the raster
+        # Camera coordinate system -> Pixel coordinate system
+        #      | -f/px    0    cols/2 |
+        # K =  |   0     f/px  rows/2 |
+        #      |   0      0      1    |
+        K = np.array([[-my_drone.focal_length / pixel_size, 0, image_cols / 2],
+                      [0, my_drone.focal_length / pixel_size, image_rows / 2],
+                      [0, 0, 1]])
+
+        return types.SimpleNamespace(
+            pixel_size=pixel_size,
+            vertices=self.__getVertices(image_rows, image_cols, pixel_size, my_drone.focal_length),  # shape: 3 x 4
+            K=K
+        )
+
+    def __grid(self, bbox, footprint, gsd):
+        """
+        Define the grid of the orthophoto
+        :param bbox: Bounding box of the footprint - [[xmin], [xmax], [ymin], [ymax]]
+        :param footprint: Vertices of the footprint | np.array of shape (4, 2)
+        :return: geotransform, boundary_rows, boundary_cols
+        """
+        if self.grid == 'north':
+            boundary_cols = int((bbox[1, 0] - bbox[0, 0]) / gsd)
+            boundary_rows = int((bbox[3, 0] - bbox[2, 0]) / gsd)
+            return np.array([bbox[0, 0], gsd, 0, bbox[3, 0], 0, -gsd]), boundary_rows, boundary_cols
+
+        # A side of the minimum-area rectangle of a convex polygon lies on one of its edges
+        center = footprint.mean(axis=0)
+        vertices = footprint - center   # Coordinates are large in EPSG 3857
+        best = None
+        for edge in np.diff(np.vstack([vertices, vertices[:1]]), axis=0):
+            theta = np.arctan2(edge[1], edge[0])
+            theta = (theta + np.pi / 4) % (np.pi / 2) - np.pi / 4   # Closest to north-up, within +-45 deg
+            u = np.array([np.cos(theta), np.sin(theta)])    # Along the columns
+            w = np.array([-np.sin(theta), np.cos(theta)])   # Against the rows
+            along_u, along_w = np.dot(vertices, u), np.dot(vertices, w)
+            area = np.ptp(along_u) * np.ptp(along_w)
+            if best is None or area < best[0]:
+                best = (area, theta, u, w, along_u, along_w)
+        _, theta, u, w, along_u, along_w = best
+
+        # Ground coordinates = origin + col * gsd * u - row * gsd * w
+        origin = center + along_u.min() * u + along_w.max() * w
+        geotransform = np.array([origin[0], gsd * u[0], -gsd * w[0], origin[1], gsd * u[1], -gsd * w[1]])
+        boundary_cols = int(np.ptp(along_u) / gsd)
+        boundary_rows = int(np.ptp(along_w) / gsd)
+        return geotransform, boundary_rows, boundary_cols
 
-        dst_ds.FlushCache()  # write to disk
-        dst_ds = None
+    @staticmethod
+    def __crop(geotransform, boundary_rows, boundary_cols, crop):
+        """
+        Restrict a grid to the pixels around a polygon
+        :param crop: Vertices of the polygon in the coordinates of the geotransform | np.array of shape (n, 2)
+        :return: geotransform, boundary_rows, boundary_cols ... or None if the grid does not overlap the polygon
+        """
+        gt = geotransform
+        # Ground coordinates -> (col, row) of the grid, which may be rotated
+        pixels = np.linalg.solve(np.array([[gt[1], gt[2]], [gt[4], gt[5]]]), (crop - [gt[0], gt[3]]).T).T
+        col0, row0 = np.maximum(np.floor(pixels.min(axis=0)).astype(int), 0)
+        col1 = min(int(np.ceil(pixels[:, 0].max())), boundary_cols)
+        row1 = min(int(np.ceil(pixels[:, 1].max())), boundary_rows)
+        if col0 >= col1 or row0 >= row1:
+            return None
+        origin_x = gt[0] + col0 * gt[1] + row0 * gt[2]
+        origin_y = gt[3] + col0 * gt[4] + row0 * gt[5]
+        return np.array([origin_x, gt[1], gt[2], origin_y, gt[4], gt[5]]), row1 - row0, col1 - col0
+
+    def __homography(self, geotransform, eo, R, ground_height, K):
+        # Orthophoto pixel (col, row) -> ground coordinates relative to the perspective center
+        #      | gt1  gt2  gt0 - X0 |
+        # A =  | gt4  gt5  gt3 - Y0 |
+        #      |  0    0    h - Z0  |
+        A = np.array([[geotransform[1], geotransform[2], geotransform[0] - eo[0]],
+                      [geotransform[4], geotransform[5], geotransform[3] - eo[1]],
+                      [0, 0, ground_height - eo[2]]])
+
+        # Orthophoto pixel -> Image pixel
+        H = np.linalg.multi_dot([K, R, A])
+        return H / H[2, 2]
+
+    def __warp(self, image, H, boundary_rows, boundary_cols):
+        if self.interpolation == cv2.INTER_NEAREST:
+            # cv2 rounds to the nearest pixel while the kernel truncates. Shift by half a pixel to sample the same one
+            H = np.dot([[1, 0, -0.5], [0, 1, -0.5], [0, 0, 1]], H)
+
+        # Pixels out of the image become transparent
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA, dst=buffers.pool.acquire(image.shape[0:2] + (4,)))
+        orthophoto = buffers.pool.acquire((boundary_rows, boundary_cols, 4))
+        # Larger orthophotos are warped in tiles, which are written back to the orthophoto
+        tiled = boundary_rows > WARP_MAX_SIZE or boundary_cols > WARP_MAX_SIZE
+        for row in range(0, boundary_rows, WARP_MAX_SIZE):
+            for col in range(0, boundary_cols, WARP_MAX_SIZE):
+                tile = np.s_[row:row + WARP_MAX_SIZE, col:col + WARP_MAX_SIZE]
+                tile_rows, tile_cols = orthophoto[tile].shape[0:2]
+                # Tile pixel -> Orthophoto pixel -> Image pixel
+                H_tile = np.dot(H, [[1, 0, col], [0, 1, row], [0, 0, 1]])
+                warped = cv2.warpPerspective(image, H_tile, (tile_cols, tile_rows),
+                                             dst=None if tiled else orthophoto,
+                                             flags=self.interpolation | cv2.WARP_INVERSE_MAP,
+                                             borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+                if tiled:
+                    orthophoto[tile] = warped
+        buffers.pool.release(image)
+        return orthophoto
+
+    def __remap(self, image, coord, boundary_rows, boundary_cols, orthophoto):
+        maps = buffers.pool.acquire((2, boundary_rows, boundary_cols), np.float32)
+        map_x, map_y = maps
+        map_x[...] = np.reshape(coord[0], (boundary_rows, boundary_cols))
+        map_y[...] = np.reshape(coord[1], (boundary_rows, boundary_cols))
+        if self.interpolation == cv2.INTER_NEAREST:
+            # cv2 rounds to the nearest pixel while the kernel truncates. Shift by half a pixel to sample the same one
+            map_x -= 0.5
+            map_y -= 0.5
+
+        # Larger orthophotos are resampled in tiles, which are written back to the orthophoto
+        tiled = boundary_rows > WARP_MAX_SIZE or boundary_cols > WARP_MAX_SIZE
+        for row in range(0, boundary_rows, WARP_MAX_SIZE):
+            for col in range(0, boundary_cols, WARP_MAX_SIZE):
+                tile = np.s_[row:row + WARP_MAX_SIZE, col:col + WARP_MAX_SIZE]
+                tile_x, tile_y = map_x[tile], map_y[tile]
+                if self.fixed_point_maps:
+                    tile_x, tile_y = cv2.convertMaps(tile_x, tile_y, cv2.CV_16SC2,
+                                                     nninterpolation=self.interpolation == cv2.INTER_NEAREST)
+
+                # Pixels out of the image become transparent
+                resampled = cv2.remap(image, tile_x, tile_y, self.interpolation,
+                                      dst=None if tiled else orthophoto,
+                                      borderMode=cv2.BORDER_CONSTANT, borderValue=(0, 0, 0, 0))
+                if tiled:
+                    orthophoto[tile] = resampled
+        buffers.pool.release(maps)
+
+    def __strips(self, boundary_rows, boundary_cols):
+        # Rows of the orthophoto rectified at once, so that the intermediate arrays fit in strip_memory
+        if not self.strip_memory:
+            strip_rows = boundary_rows
+        else:
+            strip_rows = max(1, self.strip_memory // (STRIP_BYTES_PER_PIXEL[self.method] * max(boundary_cols, 1)))
+        for row in range(0, boundary_rows, strip_rows):
+            yield row, min(strip_rows, boundary_rows - row)
 
     def __export_bbox_to_wkt(self, bbox):
+        # The ring of the polygon is closed by its first vertex
         res = "POLYGON ((" + \
-              str(bbox[0, 0]) + " " + str(bbox[0, 1]) + ", " + \
-              str(bbox[1, 0]) + " " + str(bbox[1, 1]) + ", " + \
-              str(bbox[2, 0]) + " " + str(bbox[2, 1]) + ", " + \
-              str(bbox[3, 0]) + " " + str(bbox[3, 1]) + ", " + \
-              str(bbox[0, 0]) + " " + str(bbox[0, 1]) + "))"
+              ", ".join(str(x) + " " + str(y) for x, y in list(bbox) + [bbox[0]]) + "))"
         return res
 
-    def rectify(self, img, my_drone, adjusted_eo):
-        img = cv2.imdecode(img, cv2.IMREAD_COLOR)
-
-        # 1. Restore the image based on orientation information
-        # restored_image = self.__restoreOrientation(img, io['orientation'])
-        restored_image = img
+    def _surface(self, vertices, eo, R):
+        """
+        Intersect the rays through vertices of the image with the ground
+        :param vertices: Vertices in the camera coordinate system | np.array of shape (3, n)
+        :return: Ground coordinates of the vertices | np.array of shape (n, 2), and the mean height of the ground
+        """
+        _, proj_bbox = self.__boundary(vertices, eo, R, self.height)
+        return proj_bbox, self.height
 
-        image_rows = restored_image.shape[0]
-        image_cols = restored_image.shape[1]
+    def _heights(self, geotransform, boundary_rows, boundary_cols, ground_height):
+        """
+        :param ground_height: The mean height of the ground from _surface()
+        :return: The height of the ground at every pixel of a grid | np.array of shape (rows, cols)
+        """
+        return np.broadcast_to(np.float64(self.height), (boundary_rows, boundary_cols))
+
+    def __footprint(self, img, my_drone, adjusted_eo):
+        # Read the size from the header of the image, so that it is decoded only once at the resolution needed
+        image_size = encoded_image_size(img)
+        if image_size is None:
+            decoded = cv2.imdecode(img, cv2.IMREAD_COLOR)
+            image_size = decoded.shape[0:2]
+        else:
+            decoded = None
+        image_rows, image_cols = image_size
 
-        pixel_size = my_drone.sensor_width / image_cols  # unit: mm/px
-        pixel_size = pixel_size / 1000  # unit: m/px
+        # Pixel size, vertices and camera matrix depend only on the camera and the size of the image
+        geometry = geometry_cache.get((my_drone.make, image_rows, image_cols),
+                                      lambda: self.__cameraGeometry(my_drone, image_rows, image_cols))
 
         logging.debug('Easting | Northing | Height | Omega | Phi | Kappa')
         converted_eo = self.__geographic2plane(adjusted_eo, 3857)
         R = self.__Rot3D(converted_eo)
 
         # 2. Extract a projected boundary of the image
-        bbox, proj_bbox = self.__boundary(restored_image, converted_eo, R, self.height, pixel_size, my_drone.focal_length)
+        proj_bbox, ground_height = self._surface(geometry.vertices, converted_eo, R)
+        bbox = np.array([[proj_bbox[:, 0].min()], [proj_bbox[:, 0].max()],
+                         [proj_bbox[:, 1].min()], [proj_bbox[:, 1].max()]])
+        return types.SimpleNamespace(image_size=image_size, decoded=decoded, geometry=geometry,
+                                     converted_eo=converted_eo, R=R, bbox=bbox, proj_bbox=proj_bbox,
+                                     ground_height=ground_height)
+
+    def __reduction(self, native_gsd, gsd):
+        # The largest reduction whose pixels are still smaller than the pixels of the orthophoto
+        reduction = 1
+        if self.reduced_decode:
+            for factor in (2, 4, 8):
+                if factor * native_gsd <= gsd * (1 + 1e-9):
+                    reduction = factor
+        return reduction
 
-        if self.gsd == 'auto':
-            self.gsd = (pixel_size * (converted_eo[2] - self.height)) / my_drone.focal_length  # unit: m/px
-            self.gsd *= 2
+    def rectify(self, img, my_drone, adjusted_eo):
+        orthophoto = self.rectify_orthophoto(img, my_drone, adjusted_eo)
+        return orthophoto.bbox_wkt, orthophoto.image
 
-        # Boundary size
-        boundary_cols = int((bbox[1, 0] - bbox[0, 0]) / self.gsd)
-        boundary_rows = int((bbox[3, 0] - bbox[2, 0]) / self.gsd)
+    def footprint(self, img, my_drone, adjusted_eo):
+        """
+        Project the corners of an image on the ground, without rectifying it
+        :return: Vertices of the footprint in EPSG 3857 | np.array of shape (n, 2)
+        """
+        return self.__footprint(img, my_drone, adjusted_eo).proj_bbox
 
-        proj_coords = self.__projectedCoord(bbox, boundary_rows, boundary_cols, self.gsd, converted_eo, self.height)
+    def rectify_orthophoto(self, img, my_drone, adjusted_eo, crop=None):
+        """
+        Rectify an image like rectify(), and also return the georeference of the orthophoto
+        :param crop: Vertices of a polygon in EPSG 3857 | np.array of shape (n, 2).
+                     If given, only the part of the orthophoto around the polygon is rectified
+        :return: Orthophoto
+        """
+        footprint = self.__footprint(img, my_drone, adjusted_eo)
+        decoded, geometry, converted_eo, R = footprint.decoded, footprint.geometry, footprint.converted_eo, footprint.R
+        bbox, proj_bbox = footprint.bbox, footprint.proj_bbox
+        image_rows, image_cols = footprint.image_size
+        pixel_size = geometry.pixel_size
 
-        # Image size
-        image_size = np.reshape(restored_image.shape[0:2], (2, 1))
+        native_gsd = (pixel_size * (converted_eo[2] - footprint.ground_height)) / my_drone.focal_length  # unit: m/px
+        # The automatic gsd is computed for every image. The rectifier may be reused for images of other altitudes
+        gsd = native_gsd * self.gsd_multiplier if self.gsd == 'auto' else self.gsd
 
-        backProj_coords = self.__backProjection(proj_coords, R, my_drone.focal_length, pixel_size, image_size)
+        # Decode the image at the lowest resolution which keeps the gsd of the orthophoto
+        if decoded is None:
+            decoded = cv2.imdecode(img, REDUCED_DECODES[self.__reduction(native_gsd, gsd)])
+        img = decoded
 
-        b, g, r, a = self.__resample(backProj_coords, boundary_rows, boundary_cols, img)
+        # 1. Restore the image based on orientation information
+        # restored_image = self.__restoreOrientation(img, io['orientation'])
+        restored_image = img
 
-        orthophoto_array = cv2.merge((b, g, r, a))
+        if restored_image.shape[0:2] != (image_rows, image_cols):
+            # Decoded at a reduced resolution, so the pixels are larger
+            image_rows, image_cols = restored_image.shape[0:2]
+            geometry = geometry_cache.get((my_drone.make, image_rows, image_cols),
+                                          lambda: self.__cameraGeometry(my_drone, image_rows, image_cols))
+            pixel_size = geometry.pixel_size
 
+        # Boundary size
+        geotransform, boundary_rows, boundary_cols = self.__grid(bbox, proj_bbox, gsd)
+        cropped = crop is not None and self.__crop(geotransform, boundary_rows, boundary_cols, crop)
+        if cropped:
+            geotransform, boundary_rows, boundary_cols = cropped
+        if self.method == 'homography':
+            # 3. The ground is a plane, so the image and the orthophoto are related by a homography
+            H = self.__homography(geotransform, converted_eo, R, self.height, geometry.K)
+            orthophoto_array = self.__warp(img, H, boundary_rows, boundary_cols)
+        else:
+            # The orthophoto and the scratch arrays come from the buffer pool. The caller releases the orthophoto
+            orthophoto_array = buffers.pool.acquire((boundary_rows, boundary_cols, 4))
+            if self.method == 'remap':
+                image = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA, dst=buffers.pool.acquire(img.shape[0:2] + (4,)))
+                image_size = np.reshape(restored_image.shape[0:2], (2, 1))
+
+            # 3. Rectify the orthophoto strip by strip, so that the memory does not grow with its area
+            gt = geotransform
+            for row, strip_rows in self.__strips(boundary_rows, boundary_cols):
+                strip_geotransform = np.array([gt[0] + row * gt[2], gt[1], gt[2], gt[3] + row * gt[5], gt[4], gt[5]])
+                strip = orthophoto_array[row:row + strip_rows]
+                heights = self._heights(strip_geotransform, strip_rows, boundary_cols, footprint.ground_height)
+                if self.method == 'remap':
+                    # Back-project every pixel of the strip and resample the image
+                    proj_coords = self.__projectedCoord(geotransform, row, strip_rows, boundary_cols, converted_eo,
+                                                        heights,
+                                                        buffers.pool.acquire((3, strip_rows * boundary_cols),
+                                                                             np.float64))
+                    backProj_coords = self.__backProjection(proj_coords, R, my_drone.focal_length, pixel_size,
+                                                            image_size)
+                    self.__remap(image, backProj_coords, strip_rows, boundary_cols, strip)
+                    buffers.pool.release(proj_coords)
+                    buffers.pool.release(backProj_coords)
+                else:
+                    # Project, back-project and resample in a single pass
+                    self.__rectifyKernel(geotransform, row, strip_rows, boundary_cols, converted_eo, heights, R,
+                                         my_drone.focal_length, pixel_size, img, strip)
+                buffers.pool.release(heights)
+            if self.method == 'remap':
+                buffers.pool.release(image)
+
+        if cropped:
+            # The boundary of the part rectified
+            gt = geotransform
+            proj_bbox = np.array([[gt[0] + col * gt[1] + row * gt[2], gt[3] + col * gt[4] + row * gt[5]]
+                                  for col, row in ((0, 0), (boundary_cols, 0), (boundary_cols, boundary_rows),
+                                                   (0, boundary_rows))])
         bbox_wkt = self.__export_bbox_to_wkt(proj_bbox)
 
-        return bbox_wkt, orthophoto_array
+        return Orthophoto(bbox_wkt, orthophoto_array, geotransform, gsd)
+
+
+class DEMRectifier(AverageOrthoplaneRectifier):
+    def __init__(self, dem, height, gsd='auto', method='kernel', interpolation='nearest', fixed_point_maps=False,
+                 reduced_decode=True, gsd_multiplier=2, grid='north', strip_memory=None, edge_samples=8,
+                 tolerance=0.1, max_iterations=20):
+        """
+        Initialize rectifier, which rectifies images onto a DEM.
+        :param dem: dem.ElevationModel
+        :param height: Height of the ground where the DEM has no data (float).
+        :param method: 'kernel' or 'remap'. The homography of a plane does not apply to a DEM.
+        :param edge_samples: The number of rays intersected with the DEM along each edge of an image,
+                             so that the footprint follows the terrain.
+        :param tolerance: The intersection of a ray and the DEM stops when the height changes less than it in meter.
+        :param max_iterations: The maximum number of iterations of the intersection.
+        See AverageOrthoplaneRectifier for the other parameters.
+        """
+        if method == 'homography':
+            raise ValueError("The homography method needs a flat ground")
+        super().__init__(height, gsd, method, interpolation, fixed_point_maps, reduced_decode, gsd_multiplier, grid,
+                         strip_memory)
+        self.dem = dem
+        self.edge_samples = edge_samples
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+
+    def _surface(self, vertices, eo, R):
+        # Rays along the edges of the image, from each vertex toward the next one
+        steps = np.arange(self.edge_samples) / self.edge_samples
+        following = np.roll(vertices, -1, axis=1)
+        rays = (vertices[:, :, None] + (following - vertices)[:, :, None] * steps).reshape(3, -1)
+        rays = np.dot(R.transpose(), rays)
+
+        # Iterate the height of every ray from the mean height of the ground: intersect the plane at the height,
+        # then read the height of the DEM at the intersection
+        heights = np.full(rays.shape[1], float(self.height))
+        for _ in range(self.max_iterations):
+            scale = (heights - eo[2]) / rays[2]
+            sampled = self.dem.sample(eo[0] + scale * rays[0], eo[1] + scale * rays[1])
+            sampled = np.where(np.isnan(sampled), self.height, sampled)
+            converged = np.abs(sampled - heights).max() < self.tolerance
+            heights = sampled
+            if converged:
+                break
+
+        scale = (heights - eo[2]) / rays[2]
+        footprint = np.column_stack([eo[0] + scale * rays[0], eo[1] + scale * rays[1]])
+        return footprint, float(heights.mean())
+
+    def _heights(self, geotransform, boundary_rows, boundary_cols, ground_height):
+        heights = self.dem.grid(geotransform, boundary_rows, boundary_cols,
+                                out=buffers.pool.acquire((boundary_rows, boundary_cols), np.float32))
+        heights[np.isnan(heights)] = ground_height
+        return heights
@@ -0,0 +1,55 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import pipeline
+
+
+class RectificationPool:
+    """
+    Rectification stage running in worker processes, decoupled from network I/O.
+
+    Frames of different tasks are rectified in parallel, but the results of a task are delivered in the order
+    its frames were submitted.
+    """
+    def __init__(self, num_processes, config):
+        """
+        :param num_processes: The number of worker processes. If None, the number of CPUs is used
+        :param config: Parsed config.json to configure the pipeline of the worker processes
+        """
+        self.__executor = ProcessPoolExecutor(max_workers=num_processes, initializer=pipeline.configure,
+                                              initargs=(config,))
+        self.__lock = threading.Lock()
+        self.__pending = {}     # task id -> deque of (future of the worker, ordered future)
+
+    def submit(self, task_id, fn, *args):
+        """
+        Run fn(*args) in a worker process
+        :param task_id: uuid of the task the frame belongs to
+        :param fn: A picklable function which rectifies a frame, e.g. pipeline.rectify
+        :return: concurrent.futures.Future which is resolved after all frames previously submitted for task_id
+        """
+        ordered = Future()
+        future = self.__executor.submit(fn, *args)
+        with self.__lock:
+            self.__pending.setdefault(task_id, deque()).append((future, ordered))
+        future.add_done_callback(lambda _: self.__drain(task_id))
+        return ordered
+
+    def rectify(self, task_id, img, my_drone, adjusted_eo, gsd_multiplier=None, crop=None):
+        return self.submit(task_id, pipeline.rectify, img, my_drone, adjusted_eo, gsd_multiplier, crop)
+
+    def shutdown(self, wait=True):
+        self.__executor.shutdown(wait=wait)
+
+    def __drain(self, task_id):
+        # Callbacks of an ordered future run before the next one is resolved, so consumers see the task in order
+        with self.__lock:
+            pending = self.__pending.get(task_id)
+            while pending and pending[0][0].done():
+                future, ordered = pending.popleft()
+                if future.exception() is not None:
+                    ordered.set_exception(future.exception())
+                else:
+                    ordered.set_result(future.result())
+            if not pending:
+                self.__pending.pop(task_id, None)
@@ -0,0 +1,221 @@
+import time
+import types
+from collections import deque
+
+POLICIES = ("wrr", "drr")
+
+
+class FrameScheduler:
+    """
+    Admission of frames between receiving and rectification.
+
+    Frames wait in a queue per task. Fresh frames matter more than complete ones for live mapping,
+    so under overload the latest frame wins:
+      - superseded: A task keeps at most max_pending frames. The oldest one is dropped for a new one
+      - stale: A frame older than a frame already admitted for its task (by the timestamp of the preamble) is dropped
+      - lagging: A frame more than max_lag ms older than the newest frame of its task is dropped when it is taken
+
+    Tasks with pending frames are served in turn, so a high-rate drone cannot starve the others:
+      - wrr: Weighted round-robin. A task takes up to weight frames per turn
+      - drr: Deficit round-robin. A task takes up to quantum * weight bytes of images per turn,
+             so drones sending larger images get the same share of rectification
+    """
+    def __init__(self, max_pending=2, max_lag=0, on_drop=None, policy="wrr", weights=None, default_weight=1,
+                 quantum=4 * 1024 * 1024, window=100, idle_timeout=600):
+        """
+        :param max_pending: The maximum number of pending frames per task. If 0, frames are never superseded
+        :param max_lag: The maximum lag of a frame behind the newest frame of its task in ms. If 0, no limit
+        :param on_drop: A function called with every dropped frame, e.g. to release its buffer
+        :param policy: 'wrr' or 'drr'
+        :param weights: Weights by task id (string of the uuid) | dict
+        :param default_weight: The weight of tasks not in weights
+        :param quantum: Bytes of images a task of weight 1 takes per turn in drr
+        :param window: The number of the latest frames of each task used for the latency metrics
+        :param idle_timeout: The state of a task without pending frames is forgotten when it has received no frames
+                             for idle_timeout seconds. If 0, never
+        """
+        if policy not in POLICIES:
+            raise ValueError("Unknown scheduling policy: %s" % policy)
+        if default_weight <= 0 or any(weight <= 0 for weight in (weights or {}).values()):
+            raise ValueError("Weights must be positive")
+        self.max_pending = max_pending
+        self.max_lag = max_lag
+        self.on_drop = on_drop
+        self.policy = policy
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.quantum = quantum
+        self.window = window
+        self.idle_timeout = idle_timeout
+
+        self.__tasks = {}           # task id -> state of the task
+        self.__active = deque()     # task ids with pending frames, in the order they are served
+        self.__pending = 0
+        self.__in_flight = {}       # frame id -> (task, time when the frame was admitted)
+        self.dropped = {"superseded": 0, "stale": 0, "lagging": 0}
+
+    def __len__(self):
+        return self.__pending
+
+    def put(self, frame):
+        """
+        Admit a frame
+        :param frame: socket_module.Frame
+        :return: False if the frame is dropped
+        """
+        now = time.time()
+        self.__forget_idle(now)
+        task = self.__tasks.get(frame.task_id)
+        if task is None:
+            task = self.__tasks[frame.task_id] = types.SimpleNamespace(
+                queue=deque(), newest=None, admitted=0, dropped={"superseded": 0, "stale": 0, "lagging": 0},
+                weight=self.weights.get(str(frame.task_id), self.default_weight), deficit=0, in_turn=False,
+                max_depth=0, waits=deque(maxlen=self.window), latencies=deque(maxlen=self.window), last_seen=now)
+        task.last_seen = now
+
+        if task.newest is not None and frame.timestamp < task.newest:
+            self.__drop(task, frame, "stale")
+            return False
+
+        task.newest = frame.timestamp
+        task.admitted += 1
+        if not task.queue:
+            self.__active.append(frame.task_id)
+        task.queue.append((now, frame))
+        self.__pending += 1
+
+        if self.max_pending and len(task.queue) > self.max_pending:
+            self.__pending -= 1
+            self.__drop(task, task.queue.popleft()[1], "superseded")
+        task.max_depth = max(task.max_depth, len(task.queue))
+        return True
+
+    def pop(self):
+        """
+        Take the next frame to rectify
+        :return: socket_module.Frame ... or None if no frame is pending
+        """
+        while self.__active:
+            task = self.__tasks[self.__active[0]]
+            self.__drop_lagging(task)
+            if not task.queue:
+                self.__end_turn(task, idle=True)
+                continue
+
+            if not task.in_turn:
+                task.in_turn = True
+                task.deficit += task.weight * (self.quantum if self.policy == "drr" else 1)
+            admitted_time, frame = task.queue[0]
+            cost = self.__cost(frame)
+            if cost > task.deficit:
+                # The deficit is kept, so a large frame is taken in a later turn
+                self.__end_turn(task)
+                continue
+
+            task.queue.popleft()
+            self.__pending -= 1
+            task.deficit -= cost
+            if not task.queue:
+                self.__end_turn(task, idle=True)
+
+            task.waits.append(time.time() - admitted_time)
+            self.__in_flight[frame.frame_id] = (task, admitted_time)
+            return frame
+
+    def complete(self, frame):
+        """
+        Record the latency of a frame taken by pop(), from admission until it is processed
+        :param frame: socket_module.Frame
+        """
+        in_flight = self.__in_flight.pop(frame.frame_id, None)
+        if in_flight is not None:
+            task, admitted_time = in_flight
+            task.latencies.append(time.time() - admitted_time)
+
+    def clear(self):
+        """
+        Drop every pending frame without counting it, e.g. on shutdown
+        """
+        for task in self.__tasks.values():
+            while task.queue:
+                frame = task.queue.popleft()[1]
+                if self.on_drop is not None:
+                    self.on_drop(frame)
+            task.in_turn = False
+            task.deficit = 0
+        self.__active.clear()
+        self.__in_flight.clear()
+        self.__pending = 0
+
+    def stats(self):
+        """
+        :return: The number of pending and dropped frames, in total and by task, with the queue depth,
+                 and the mean and 95th percentile of the waiting time and latency of each task in seconds.
+                 Forgotten idle tasks are only counted in the totals
+        """
+        self.__forget_idle(time.time())
+        return {"pending": self.__pending, "dropped": dict(self.dropped),
+                "tasks": {str(task_id): {"weight": task.weight, "pending": len(task.queue),
+                                         "max_pending": task.max_depth, "admitted": task.admitted,
+                                         "dropped": dict(task.dropped), "wait": summarize(task.waits),
+                                         "latency": summarize(task.latencies)}
+                          for task_id, task in self.__tasks.items()}}
+
+    def __forget_idle(self, now):
+        # Tasks still queued are in self.__active and keep their state. The totals in self.dropped are kept
+        if not self.idle_timeout:
+            return
+        idle = [task_id for task_id, task in self.__tasks.items()
+                if not task.queue and not task.in_turn and now - task.last_seen > self.idle_timeout]
+        for task_id in idle:
+            del self.__tasks[task_id]
+
+    def __cost(self, frame):
+        return len(frame.image) if self.policy == "drr" else 1
+
+    def __end_turn(self, task, idle=False):
+        task.in_turn = False
+        task_id = self.__active.popleft()
+        if idle:
+            # An idle task does not keep its deficit
+            task.deficit = 0
+        else:
+            self.__active.append(task_id)
+
+    def __drop_lagging(self, task):
+        while self.max_lag and task.queue and task.newest - task.queue[0][1].timestamp > self.max_lag:
+            self.__pending -= 1
+            self.__drop(task, task.queue.popleft()[1], "lagging")
+
+    def __drop(self, task, frame, reason):
+        task.dropped[reason] += 1
+        self.dropped[reason] += 1
+        if self.on_drop is not None:
+            self.on_drop(frame)
+
+
+def summarize(seconds):
+    """
+    :param seconds: Measured times in seconds
+    :return: The number, mean and 95th percentile of the times
+    """
+    if not seconds:
+        return {"count": 0, "mean": None, "p95": None}
+    ordered = sorted(seconds)
+    return {"count": len(ordered), "mean": sum(ordered) / len(ordered),
+            "p95": ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]}
+
+
+def create_scheduler(config, on_drop=None):
+    """
+    Create a scheduler from the scheduler section of config.json
+    :param config: Parsed config.json
+    :param on_drop: A function called with every dropped frame
+    :return: FrameScheduler
+    """
+    scheduler = config.get("scheduler", {})
+    return FrameScheduler(max_pending=scheduler.get("MAX_PENDING", 2), max_lag=scheduler.get("MAX_LAG_MS", 0),
+                          on_drop=on_drop, policy=scheduler.get("POLICY", "wrr"), weights=scheduler.get("WEIGHTS"),
+                          default_weight=scheduler.get("DEFAULT_WEIGHT", 1),
+                          quantum=int(scheduler.get("QUANTUM_MB", 4) * 1024 * 1024),
+                          idle_timeout=scheduler.get("IDLE_TIMEOUT_S", 600))
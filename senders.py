@@ -0,0 +1,184 @@
+import socket
+import threading
+from collections import deque
+from socket_module import send_buffers
+
+
+class OutboundSender:
+    """
+    Send packets to a downstream endpoint (e.g. web map viewer) from a background thread.
+
+    Packets wait in a bounded queue, so a slow or disconnected endpoint never stalls ingest.
+    When the queue is full, the oldest or the newest packet is dropped.
+    The connection is re-established with exponential backoff.
+    An endpoint which stops reading is disconnected after send_timeout, and the packet being sent is dropped.
+    """
+    def __init__(self, address, queue_limit=8, drop_policy="oldest", min_backoff=0.5, max_backoff=30.0, name=None,
+                 send_timeout=10.0):
+        """
+        :param address: (IP, PORT) of the endpoint
+        :param queue_limit: The maximum number of packets waiting to be sent
+        :param drop_policy: 'oldest' drops the oldest packet in the queue, 'newest' drops the packet being submitted
+        :param min_backoff: The first delay before reconnecting in seconds
+        :param max_backoff: The maximum delay before reconnecting in seconds
+        :param send_timeout: The maximum time to wait for the endpoint to accept more bytes of a packet in seconds
+        """
+        if drop_policy not in ("oldest", "newest"):
+            raise ValueError("Unknown drop policy: %s" % drop_policy)
+        self.address = address
+        self.queue_limit = queue_limit
+        self.drop_policy = drop_policy
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.send_timeout = send_timeout
+        self.name = name or "%s:%d" % address
+
+        self.sent = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+        self.__queue = deque()
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__sock = None
+        self.__connected_once = False
+        self.__thread = threading.Thread(target=self.__run, name="sender-" + self.name, daemon=True)
+        self.__thread.start()
+
+    def submit(self, buffers):
+        """
+        Queue a packet without blocking
+        :param buffers: Buffers of a packet ... from socket_module.pack_packet
+        :return: False if the packet is dropped
+        """
+        with self.__condition:
+            if len(self.__queue) >= self.queue_limit:
+                self.dropped += 1
+                if self.drop_policy == "newest":
+                    return False
+                self.__queue.popleft()
+            self.__queue.append(buffers)
+            self.__condition.notify()
+        return True
+
+    def stats(self):
+        with self.__condition:
+            return {"queued": len(self.__queue), "sent": self.sent, "dropped": self.dropped,
+                    "reconnects": self.reconnects, "connected": self.__sock is not None}
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+        self.__thread.join()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__queue and not self.__closed:
+                    self.__condition.wait()
+                if self.__closed:
+                    break
+
+            self.__connect()
+            if self.__sock is None:
+                break
+            with self.__condition:
+                # Packets may have been dropped while connecting
+                if not self.__queue:
+                    continue
+                # Taken off the queue, so that the drop policy never drops the packet being sent
+                buffers = self.__queue.popleft()
+            try:
+                send_buffers(self.__sock, buffers)
+            except OSError as e:
+                # Part of the packet may have been sent. Drop it and send the next packets on a new connection
+                print(self.name, e)
+                self.__disconnect()
+                with self.__condition:
+                    self.dropped += 1
+                continue
+
+            with self.__condition:
+                self.sent += 1
+
+        self.__disconnect()
+
+    def __connect(self):
+        backoff = self.min_backoff
+        while self.__sock is None:
+            with self.__condition:
+                if self.__closed:
+                    return
+            try:
+                print('starting connection to', self.name)
+                self.__sock = socket.create_connection(self.address, timeout=self.max_backoff)
+                # socket.timeout is an OSError, so a send which does not progress reconnects
+                self.__sock.settimeout(self.send_timeout)
+                print("Connected!")
+                if self.__connected_once:
+                    self.reconnects += 1
+                self.__connected_once = True
+            except OSError as e:
+                print(self.name, e)
+                with self.__condition:
+                    self.__condition.wait(backoff)  # Wakes up early on close
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def __disconnect(self):
+        if self.__sock is not None:
+            self.__sock.close()
+            self.__sock = None
+
+
+class FanOutSender:
+    """
+    Send the same packets to several subscribers (e.g. web map viewer, archive, QA dashboard).
+
+    A packet is packed and encoded once, and its buffers are shared by every subscriber.
+    Each subscriber has its own connection and queue, so a slow subscriber only drops its own packets.
+    """
+    def __init__(self, senders):
+        """
+        :param senders: OutboundSender of each subscriber
+        """
+        self.senders = list(senders)
+
+    def submit(self, buffers):
+        """
+        Queue a packet to every subscriber without blocking
+        :param buffers: Buffers of a packet ... from socket_module.pack_packet. They must not be modified afterwards
+        :return: False if the packet is dropped by every subscriber
+        """
+        buffers = tuple(buffers)
+        accepted = [sender.submit(buffers) for sender in self.senders]
+        return any(accepted)
+
+    def stats(self):
+        return {sender.name: sender.stats() for sender in self.senders}
+
+    def close(self):
+        for sender in self.senders:
+            sender.close()
+
+
+def create_sender(config):
+    """
+    Create a sender to the subscribers section of config.json.
+    The client section of older configurations is only used if there is no subscribers section
+    :param config: Parsed config.json
+    :return: OutboundSender or FanOutSender
+    """
+    subscribers = config.get("subscribers")
+    if not subscribers:
+        return _create_outbound_sender(config["client"])
+    if "client" in config:
+        print("The client section is ignored in favor of the subscribers section")
+    return FanOutSender(_create_outbound_sender(subscriber) for subscriber in subscribers)
+
+
+def _create_outbound_sender(endpoint):
+    return OutboundSender((endpoint["IP"], endpoint["PORT"]), queue_limit=endpoint.get("QUEUE_LIMIT", 8),
+                          drop_policy=endpoint.get("DROP_POLICY", "oldest"),
+                          max_backoff=endpoint.get("MAX_BACKOFF", 30.0), name=endpoint.get("NAME"),
+                          send_timeout=endpoint.get("SEND_TIMEOUT", 10.0))
@@ -5,6 +5,8 @@ from struct import *
 import logging
 import cv2
 import time
+from collections import namedtuple
+from encoders import EncodedImage, PngEncoder
 
 
 # https://stackoverflow.com/questions/55014710/zero-fill-right-shift-in-python
@@ -30,69 +32,182 @@ def parse_header(binary_header):
     return result
 
 
-def receive(c_sock):
-    binaryHeader = c_sock.recv(2)  # Read the length of header
-    if binaryHeader == b"":
-        return
-    packetHeader = parse_header(binaryHeader)
-    timeStamp = c_sock.recv(8)
-    timeStamp = np.frombuffer(timeStamp, dtype="int64")[0]
-    payloadLength = c_sock.recv(4)
-    payloadLength = np.frombuffer(payloadLength, dtype="int32")[0]
-
-    # https://docs.python.org/ko/3/library/uuid.html
-    taskID = c_sock.recv(16)
-    taskID = uuid.UUID(bytes=taskID)
-    frameID = c_sock.recv(16)
-    frameID = uuid.UUID(bytes=frameID)
-    latitude = c_sock.recv(8)
-    latitude = np.frombuffer(latitude, dtype="double")[0]
-    longitude = c_sock.recv(8)
-    longitude = np.frombuffer(longitude, dtype="double")[0]
-    altitude = c_sock.recv(4)
-    altitude = np.frombuffer(altitude, dtype="float32")[0]
-    accuracy = c_sock.recv(4)
-    accuracy = np.frombuffer(accuracy, dtype="float32")[0]
-    jsonDataSize = c_sock.recv(4)
-    jsonDataSize = np.frombuffer(jsonDataSize, dtype="int32")[0]
-
-    jsonData = c_sock.recv(jsonDataSize)    # binary
-    # https://stackoverflow.com/questions/40059654/python-convert-a-bytes-array-into-json-format
-    my_json = jsonData.decode('utf8').replace("'", '"')
-    # Load the JSON to a Python list & dump it back out as formatted JSON
-    data = json.loads(my_json)
-    # dumped_json = json.dumps(data, indent=4, sort_keys=True)
-    # print(dumped_json)
-
-    # jsonObject
-    imageBinaryLength = c_sock.recv(4)
-    imageBinaryLength = np.frombuffer(imageBinaryLength, dtype="int32")[0]
-
-    byteBuff = b''
-    while len(byteBuff) < imageBinaryLength:
-        byteBuff += c_sock.recv(imageBinaryLength - len(byteBuff))
-    nparr = np.frombuffer(byteBuff, dtype="uint8")
-    if len(byteBuff) == 0:
+default_encoder = PngEncoder()
+
+# Fixed-size preamble of a packet from a drone (74 bytes, little-endian)
+# binaryHeader(2) | timeStamp(8) | payloadLength(4) | taskID(16) | frameID(16) |
+# latitude(8) | longitude(8) | altitude(4) | accuracy(4) | jsonDataSize(4)
+PREAMBLE = Struct('<2sqi16s16sddffi')
+IMAGE_LENGTH = Struct('<i')
+
+Frame = namedtuple('Frame', ['header', 'timestamp', 'payload_length', 'task_id', 'frame_id',
+                             'latitude', 'longitude', 'altitude', 'accuracy', 'metadata', 'image', 'slot'])
+
+_PREAMBLE, _JSON, _IMAGE = range(3)
+
+
+class FrameParser:
+    """
+    Incremental parser of packets from drones. It does not do its own I/O.
+
+    Fill the buffer returned by recv_buffer() (e.g. using socket.recv_into) and report the number of bytes
+    written to feed(). feed() returns a Frame when a whole packet is received.
+
+    By default the image payload is received into one buffer reused for every frame,
+    so the image of a frame is only valid until the next frame is fed.
+    """
+    def __init__(self, allocate=None, capacity=65536):
+        """
+        :param allocate: A function allocate(length) which returns (slot, buffer) for the image payload.
+                         slot is any token identifying the buffer and is returned in Frame.slot
+        :param capacity: Initial size of the buffer for the preamble and the json data in bytes
+        """
+        self.__buffer = bytearray(capacity)
+        self.__image_buffer = bytearray(0)
+        self.__allocate = allocate if allocate is not None else self.__reuse_image_buffer
+        self.reset()
+
+    def reset(self):
+        self.__state = _PREAMBLE
+        self.__view = memoryview(self.__buffer)[:PREAMBLE.size]
+        self.__filled = 0
+        self.__preamble = None
+        self.__metadata = None
+        self.__slot = None
+
+    def abort(self):
+        """
+        Discard a partially received packet, e.g. when the connection is closed.
+        :return: The slot allocated for the image of the packet, which the caller should release, or None
+        """
+        slot = self.__slot
+        self.reset()
+        return slot
+
+    def recv_buffer(self):
+        """
+        :return: A writable memoryview to be filled with the next bytes of the stream
+        """
+        return self.__view[self.__filled:]
+
+    def feed(self, nbytes):
+        """
+        Advance the parser by nbytes written to the buffer returned by recv_buffer().
+        :param nbytes: The number of bytes written
+        :return: A Frame if a whole packet is received, otherwise None
+        """
+        self.__filled += nbytes
+        if self.__filled < len(self.__view):
+            return None
+
+        if self.__state == _PREAMBLE:
+            self.__preamble = PREAMBLE.unpack(self.__view)
+            json_size = self.__preamble[-1]
+            if json_size < 0:
+                raise ValueError("Invalid size of json data: %d" % json_size)
+            # Json data and the length of the image follow the preamble
+            self.__expect(_JSON, self.__header_view(json_size + IMAGE_LENGTH.size))
+        elif self.__state == _JSON:
+            json_size = len(self.__view) - IMAGE_LENGTH.size
+            # https://stackoverflow.com/questions/40059654/python-convert-a-bytes-array-into-json-format
+            my_json = str(self.__view[:json_size], 'utf8').replace("'", '"')
+            self.__metadata = json.loads(my_json)
+            image_length = IMAGE_LENGTH.unpack_from(self.__view, json_size)[0]
+            if image_length <= 0:
+                raise ValueError("Invalid length of image: %d" % image_length)
+            self.__slot, buffer = self.__allocate(image_length)
+            self.__expect(_IMAGE, memoryview(buffer).cast('B')[:image_length])
+        else:
+            frame = self.__frame()
+            self.reset()
+            return frame
+
+        return None
+
+    def __expect(self, state, view):
+        self.__state = state
+        self.__view = view
+        self.__filled = 0
+
+    def __header_view(self, size):
+        if len(self.__buffer) < size:
+            self.__buffer = bytearray(size)
+        return memoryview(self.__buffer)[:size]
+
+    def __reuse_image_buffer(self, length):
+        if len(self.__image_buffer) < length:
+            self.__image_buffer = bytearray(length)
+        return None, self.__image_buffer
+
+    def __frame(self):
+        header, timestamp, payload_length, task_id, frame_id, latitude, longitude, altitude, accuracy, _ = \
+            self.__preamble
+        # https://docs.python.org/ko/3/library/uuid.html
+        return Frame(header=parse_header(header), timestamp=timestamp, payload_length=payload_length,
+                     task_id=uuid.UUID(bytes=task_id), frame_id=uuid.UUID(bytes=frame_id),
+                     latitude=latitude, longitude=longitude, altitude=altitude, accuracy=accuracy,
+                     metadata=self.__metadata, image=np.frombuffer(self.__view, dtype="uint8"), slot=self.__slot)
+
+
+def read_frame(c_sock, parser):
+    """
+    Read a whole packet from a blocking socket
+    :param c_sock: A socket connected to a drone
+    :param parser: FrameParser of the connection
+    :return: Frame, or None if the connection is closed
+    """
+    while True:
+        nbytes = c_sock.recv_into(parser.recv_buffer())
+        if nbytes == 0:
+            return None
+        frame = parser.feed(nbytes)
+        if frame is not None:
+            return frame
+
+
+def receive(c_sock, parser=None):
+    """
+    Receive a packet from a drone
+    :param c_sock: A socket connected to a drone
+    :param parser: FrameParser kept for the connection. If None, a new parser is used
+    :return: taskID, frameID, latitude, longitude, altitude, roll, pitch, yaw, camera, image
+             or None if the connection is closed
+    """
+    if parser is None:
+        parser = FrameParser()
+    frame = read_frame(c_sock, parser)
+    if frame is None:
         return
 
-    # print(timeStamp, payloadLength, taskID, frameID, latitude, longitude, altitude, accuracy, jsonDataSize,
-    #       data["roll"], data["pitch"], data["yaw"], data["exif"]["Model"])
+    # print(frame.timestamp, frame.payload_length, frame.task_id, frame.frame_id, frame.latitude, frame.longitude,
+    #       frame.altitude, frame.accuracy, frame.metadata["roll"], frame.metadata["pitch"],
+    #       frame.metadata["yaw"], frame.metadata["exif"]["Model"])
 
-    return taskID, frameID, latitude, longitude, altitude, \
-           data["roll"], data["pitch"], data["yaw"], data["exif"]["Model"], nparr
+    data = frame.metadata
+    return frame.task_id, frame.frame_id, frame.latitude, frame.longitude, frame.altitude, \
+           data["roll"], data["pitch"], data["yaw"], data["exif"]["Model"], frame.image
 
 
-def send(frame_id, task_id, name, img_type, img_boundary, objects, orthophoto, client):
+def pack_packet(frame_id, task_id, name, img_type, img_boundary, objects, orthophoto, encoder=None, metadata=None):
     """
-        Create a metadata of an orthophoto for tcp transmission
+        Create a packet of an orthophoto for tcp transmission
         :param frame_id: uuid of the image | string
         :param task_id: task id of the image | string
         :param name: A name of the original image | string
         :param img_type: A type of the image - optical(0)/thermal(1) | int
         :param img_boundary: Boundary of the orthophoto | string in wkt
         :param objects: JSON object? array? of the detected object ... from create_obj_metadata
-        :return: JSON object of the orthophoto ... python dictionary
+        :param orthophoto: An orthophoto (np.array) or an orthophoto already encoded (encoders.EncodedImage)
+        :param encoder: encoders.BaseEncoder or encoders.EncoderPool for an orthophoto not encoded yet.
+                        If None, PNG
+        :param metadata: Additional items of the metadata, e.g. gsd of the orthophoto | dict
+        :return: Buffers of the packet - header, metadata and image ... list of bytes-like objects
     """
+    # Write image to memory
+    if not isinstance(orthophoto, EncodedImage):
+        orthophoto = (encoder or default_encoder).encode(orthophoto)
+    orthophoto_length = sum(len(part) for part in orthophoto.parts)
+
     img_metadata = {
         "uid": str(frame_id),  # string
         "task_id": str(task_id),  # string
@@ -101,21 +216,44 @@ def send(frame_id, task_id, name, img_type, img_boundary, objects, orthophoto, c
         "img_boundary": img_boundary,  # WKT ... string
         "objects": objects
     }
+    img_metadata.update(orthophoto.metadata)
+    if metadata is not None:
+        img_metadata.update(metadata)
     img_metadata_bytes = json.dumps(img_metadata).encode()
 
     # print(img_metadata)
 
-    # Write image to memory
-    orthophoto_encode = cv2.imencode('.png', orthophoto)
-    orthophoto_bytes = orthophoto_encode[1].tostring()
+    full_length = len(img_metadata_bytes) + orthophoto_length
+    header = pack('<4siii', b"IPOD", full_length, len(img_metadata_bytes), orthophoto_length)  # s: string, i: int
+    logging.debug("IPOD %d %d %d %s", full_length, len(img_metadata_bytes), orthophoto_length, img_metadata_bytes)
+    return [header, img_metadata_bytes] + orthophoto.parts
+
 
+def send_buffers(client, buffers):
+    """
+    Write buffers to a blocking socket with scatter-gather writes, without concatenating them
+    :param client: A connected socket
+    :param buffers: bytes-like objects
+    """
+    views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer) > 0]
+    while views:
+        sent = client.sendmsg(views)
+        # A partial write may end in the middle of any buffer
+        while sent > 0:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+def send(frame_id, task_id, name, img_type, img_boundary, objects, orthophoto, client, encoder=None):
+    """
+        Send an orthophoto and its metadata. See pack_packet for the parameters.
+        :param client: A connected socket
+    """
     #############################################
     # Send object information to web map viewer #
     #############################################
-    full_length = len(img_metadata_bytes) + len(orthophoto_bytes)
-    fmt = '<4siii' + str(len(img_metadata_bytes)) + 's' + str(len(orthophoto_bytes)) + 's'  # s: string, i: int
-    print(fmt, b"IPOD", full_length, len(img_metadata_bytes), len(orthophoto_bytes),
-                        img_metadata_bytes)
-    data_to_send = pack(fmt, b"IPOD", full_length, len(img_metadata_bytes), len(orthophoto_bytes),
-                        img_metadata_bytes, orthophoto_bytes)
-    client.send(data_to_send)
+    send_buffers(client, pack_packet(frame_id, task_id, name, img_type, img_boundary, objects, orthophoto, encoder))
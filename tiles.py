@@ -0,0 +1,239 @@
+import os
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+import projections
+
+TILE_SIZE = 256     # px
+ORIGIN = np.pi * projections.EARTH_RADIUS   # Half of the extent of Web Mercator, m
+
+
+def tile_span(zoom):
+    """
+    :return: The width of a tile at a zoom level in meter
+    """
+    return 2 * ORIGIN / 2 ** zoom
+
+
+def tile_bounds(zoom, x, y):
+    """
+    :return: xmin, ymin, xmax, ymax of an XYZ tile in EPSG 3857
+    """
+    span = tile_span(zoom)
+    xmin = -ORIGIN + x * span
+    ymax = ORIGIN - y * span
+    return xmin, ymax - span, xmin + span, ymax
+
+
+def tile_wkt(zoom, x, y):
+    xmin, ymin, xmax, ymax = tile_bounds(zoom, x, y)
+    return "POLYGON ((%r %r, %r %r, %r %r, %r %r, %r %r))" % (xmin, ymax, xmax, ymax, xmax, ymin, xmin, ymin,
+                                                               xmin, ymax)
+
+
+def premultiply(tile):
+    # Colors are weighted by alpha, so that transparent pixels do not darken interpolated pixels
+    premultiplied = tile.astype(np.float32)
+    premultiplied[:, :, :3] *= premultiplied[:, :, 3:] / 255
+    return premultiplied
+
+
+def unpremultiply(premultiplied):
+    alpha = premultiplied[:, :, 3:]
+    tile = premultiplied.copy()
+    tile[:, :, :3] = np.divide(premultiplied[:, :, :3] * 255, alpha, out=np.zeros_like(tile[:, :, :3]),
+                               where=alpha > 0)
+    return np.clip(np.rint(tile), 0, 255).astype(np.uint8)
+
+
+def extent(geotransform, rows, cols):
+    """
+    :return: xmin, ymin, xmax, ymax of a raster, which may be rotated
+    """
+    gt = geotransform
+    corners = np.array([[gt[0] + col * gt[1] + row * gt[2], gt[3] + col * gt[4] + row * gt[5]]
+                        for col, row in ((0, 0), (cols, 0), (cols, rows), (0, rows))])
+    (xmin, ymin), (xmax, ymax) = corners.min(axis=0), corners.max(axis=0)
+    return xmin, ymin, xmax, ymax
+
+
+def warp(image, geotransform, xmin, ymax, resolution, size, interpolation=cv2.INTER_LINEAR):
+    """
+    Resample a raster onto a north-up grid
+    :param image: A raster, e.g. an orthophoto | np.array
+    :param geotransform: GDAL geotransform of the raster
+    :param xmin: x of the upper left corner of the grid
+    :param ymax: y of the upper left corner of the grid
+    :param resolution: The size of a pixel of the grid
+    :param size: (cols, rows) of the grid
+    :return: The raster on the grid. Pixels out of the raster are 0
+    """
+    # Grid pixel -> ground coordinates -> raster pixel. cv2 puts the centers of pixels at integers
+    grid_to_ground = np.array([[resolution, 0, xmin + resolution / 2],
+                               [0, -resolution, ymax - resolution / 2],
+                               [0, 0, 1]])
+    gt = geotransform
+    raster_to_ground = np.array([[gt[1], gt[2], gt[0] + (gt[1] + gt[2]) / 2],
+                                 [gt[4], gt[5], gt[3] + (gt[4] + gt[5]) / 2],
+                                 [0, 0, 1]])
+    M = np.dot(np.linalg.inv(raster_to_ground), grid_to_ground)[0:2]
+    return cv2.warpAffine(image, M, size, flags=interpolation | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+class TileStore:
+    """
+    Tiles of 4 channels (BGRA) stored as PNG files - directory/task id/z/x/y.png - with an LRU memory cache
+    """
+    def __init__(self, directory, cache_size=1024):
+        """
+        :param directory: The root directory of the tiles
+        :param cache_size: The maximum number of tiles kept in memory
+        """
+        self.directory = directory
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.__cache = OrderedDict()
+
+    def path(self, key):
+        """
+        :param key: (task id, z, x, y)
+        """
+        task_id, zoom, x, y = key
+        return os.path.join(self.directory, str(task_id), str(zoom), str(x), "%d.png" % y)
+
+    def get(self, key):
+        """
+        :return: The tile ... or None if it does not exist
+        """
+        tile = self.__cache.get(key)
+        if tile is not None:
+            self.hits += 1
+            self.__cache.move_to_end(key)
+            return tile
+
+        self.misses += 1
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        tile = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        self.__remember(key, tile)
+        return tile
+
+    def put(self, key, tile):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cv2.imwrite(path, tile, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        self.__remember(key, tile)
+
+    def __remember(self, key, tile):
+        self.__cache[key] = tile
+        self.__cache.move_to_end(key)
+        while len(self.__cache) > self.cache_size:
+            self.__cache.popitem(last=False)
+
+
+class TilePyramid:
+    """
+    Incremental XYZ tile pyramid of the orthophotos of each task.
+
+    An orthophoto is cut into the tiles of max_zoom, over the tiles already there.
+    The overviews are rebuilt only above the tiles which changed, by downsampling their 4 children.
+    """
+    def __init__(self, store, min_zoom=12, max_zoom=19):
+        """
+        :param store: TileStore
+        :param min_zoom: The lowest zoom level of the overviews
+        :param max_zoom: The zoom level the orthophotos are cut into
+        """
+        if not 0 <= min_zoom <= max_zoom:
+            raise ValueError("Invalid zoom levels: %d - %d" % (min_zoom, max_zoom))
+        self.store = store
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.__lock = threading.Lock()
+
+    def add(self, task_id, orthophoto):
+        """
+        Add an orthophoto to the pyramid of its task
+        :param task_id: uuid of the task
+        :param orthophoto: rectifiers.Orthophoto in EPSG 3857
+        :return: Tiles which changed - list of ((z, x, y), tile) from max_zoom to min_zoom
+        """
+        with self.__lock:
+            changed = []
+            for x, y in self.__covered_tiles(orthophoto):
+                tile = self.__cut(task_id, orthophoto, x, y)
+                if tile is not None:
+                    changed.append(((self.max_zoom, x, y), tile))
+
+            level = changed
+            for zoom in range(self.max_zoom - 1, self.min_zoom - 1, -1):
+                parents = sorted({(x // 2, y // 2) for (_, x, y), _ in level})
+                level = []
+                for x, y in parents:
+                    tile = self.__downsample(task_id, zoom, x, y)
+                    if tile is not None:
+                        level.append(((zoom, x, y), tile))
+                changed.extend(level)
+            return changed
+
+    def __covered_tiles(self, orthophoto):
+        xmin, ymin, xmax, ymax = extent(orthophoto.geotransform, *orthophoto.image.shape[0:2])
+        # y of XYZ tiles grows southward
+        span = tile_span(self.max_zoom)
+        last = 2 ** self.max_zoom - 1
+        x_min, x_max = [int(min(max((x + ORIGIN) // span, 0), last)) for x in (xmin, xmax)]
+        y_min, y_max = [int(min(max((ORIGIN - y) // span, 0), last)) for y in (ymax, ymin)]
+        return [(x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)]
+
+    def __cut(self, task_id, orthophoto, x, y):
+        xmin, _, _, ymax = tile_bounds(self.max_zoom, x, y)
+        cut = warp(orthophoto.image, orthophoto.geotransform, xmin, ymax, tile_span(self.max_zoom) / TILE_SIZE,
+                   (TILE_SIZE, TILE_SIZE))
+        # Pixels mostly inside the orthophoto replace the pixels of the tile
+        covered = cut[:, :, 3] >= 128
+        if not covered.any():
+            return None
+        cut = unpremultiply(cut.astype(np.float32))   # Transparent pixels are black, so the cut is premultiplied
+
+        key = (task_id, self.max_zoom, x, y)
+        previous = self.store.get(key)
+        tile = previous.copy() if previous is not None else np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+        tile[covered, 0:3] = cut[covered, 0:3]
+        tile[covered, 3] = 255
+        if previous is not None and np.array_equal(tile, previous):
+            return None
+        self.store.put(key, tile)
+        return tile
+
+    def __downsample(self, task_id, zoom, x, y):
+        children = np.zeros((2 * TILE_SIZE, 2 * TILE_SIZE, 4), dtype=np.uint8)
+        for dx in (0, 1):
+            for dy in (0, 1):
+                child = self.store.get((task_id, zoom + 1, 2 * x + dx, 2 * y + dy))
+                if child is not None:
+                    children[dy * TILE_SIZE:(dy + 1) * TILE_SIZE, dx * TILE_SIZE:(dx + 1) * TILE_SIZE] = child
+        tile = unpremultiply(cv2.resize(premultiply(children), (TILE_SIZE, TILE_SIZE), interpolation=cv2.INTER_AREA))
+
+        key = (task_id, zoom, x, y)
+        previous = self.store.get(key)
+        if previous is not None and np.array_equal(tile, previous):
+            return None
+        self.store.put(key, tile)
+        return tile
+
+
+def create_tile_pyramid(config):
+    """
+    Create a tile pyramid from the tiles section of config.json
+    :param config: Parsed config.json
+    :return: TilePyramid ... or None if ENABLED is false
+    """
+    tiles = config.get("tiles", {})
+    if not tiles.get("ENABLED", False):
+        return None
+    store = TileStore(tiles.get("DIRECTORY", "tiles"), tiles.get("CACHE_SIZE", 1024))
+    return TilePyramid(store, tiles.get("MIN_ZOOM", 12), tiles.get("MAX_ZOOM", 19))